@@ -44,6 +44,19 @@ contract Source is AccessControl {
     
     function withdraw(address _token, address _recipient, uint256 _amount) 
         public onlyRole(WARDEN_ROLE) {
+        _withdraw(_token, _recipient, _amount);
+    }
+    
+    // Relays several unwraps in one transaction so each one does not pay the base transaction cost
+    function batchWithdraw(address[] calldata _tokens, address[] calldata _recipients, uint256[] calldata _amounts) 
+        public onlyRole(WARDEN_ROLE) {
+        require(_tokens.length == _recipients.length && _recipients.length == _amounts.length, "Length mismatch");
+        for (uint256 i = 0; i < _tokens.length; i++) {
+            _withdraw(_tokens[i], _recipients[i], _amounts[i]);
+        }
+    }
+    
+    function _withdraw(address _token, address _recipient, uint256 _amount) internal {
         require(_recipient != address(0), "Invalid recipient");
         require(_amount > 0, "Invalid amount");
         require(ERC20(_token).transfer(_recipient, _amount), "Transfer failed");
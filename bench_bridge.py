@@ -0,0 +1,244 @@
+"""
+    End-to-end benchmark of the bridge relay on two local in-process EVMs (eth-tester/py-evm)
+
+    Deploys Source.sol, Destination.sol and BridgeToken.sol, makes N deposits across the registered tokens,
+    runs bridge.scan_blocks until every deposit is wrapped, and reports events/sec, RPC calls per event,
+    gas per event and p50/p99 relay latency
+
+    Needs web3[tester] and py-solc-x, and a checkout of openzeppelin-contracts for the imports, e.g.
+        python bench_bridge.py --oz ../openzeppelin-contracts -n 200 --batch --out new.json --baseline old.json
+"""
+from web3 import Web3, EthereumTesterProvider
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import eth_account
+import solcx
+import bridge
+
+
+SOLC_VERSION = "0.8.20"
+RELAY_TIMEOUT = 600  # Give up if the relay makes no progress for this many seconds
+CONTRACTS = ["Source.sol", "Destination.sol", "BridgeToken.sol"]
+
+
+class CountingProvider(EthereumTesterProvider):
+    """
+        EthereumTesterProvider that counts RPC calls and records when each raw transaction was mined
+        (eth-tester mines every transaction as soon as it is sent)
+        Requests are serialized, since the relay's receipt tracker polls from a background thread
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+        self.mined_at = {}  # tx hash (hex) -> wall clock time
+        self.lock = threading.RLock()
+
+    def make_request(self, method, params):
+        with self.lock:
+            return self._make_request(method, params)
+
+    def _make_request(self, method, params):
+        self.calls += 1
+        response = super().make_request(method, params)
+        if method == 'eth_sendRawTransaction' and 'result' in response:
+            tx_hash = response['result']
+            self.mined_at[tx_hash if isinstance(tx_hash, str) else Web3.to_hex(tx_hash)] = time.time()
+        return response
+
+
+def compile_contracts(oz_path):
+    """
+        Compiles the bridge contracts, returns a dictionary mapping contract name to (abi, bytecode)
+    """
+    solcx.install_solc(SOLC_VERSION)
+    here = Path(__file__).parent.absolute()
+    oz_path = Path(oz_path).absolute()
+    output = solcx.compile_files(
+        [str(here / name) for name in CONTRACTS],
+        output_values=['abi', 'bin'],
+        solc_version=SOLC_VERSION,
+        import_remappings=[f"@openzeppelin/={oz_path}/"],
+        allow_paths=[str(here), str(oz_path)],
+    )
+    compiled = {}
+    for key, value in output.items():
+        compiled[key.split(':')[-1]] = (value['abi'], value['bin'])
+    return compiled
+
+
+def contracts_hash():
+    """
+        Short hash of the contract sources, so results can be matched to the contracts they were measured on
+    """
+    here = Path(__file__).parent.absolute()
+    digest = hashlib.sha256()
+    for name in CONTRACTS:
+        digest.update((here / name).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def send_tx(w3, account, fn):
+    """
+        Signs and sends fn (a contract function call or constructor) from account, returns the receipt
+    """
+    transaction = fn.build_transaction({
+        'from': account.address,
+        'nonce': w3.eth.get_transaction_count(account.address),
+    })
+    signed_txn = w3.eth.account.sign_transaction(transaction, account.key)
+    tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+    return w3.eth.wait_for_transaction_receipt(tx_hash)
+
+
+def deploy(w3, account, compiled, name, *args):
+    abi, bytecode = compiled[name]
+    receipt = send_tx(w3, account, w3.eth.contract(abi=abi, bytecode=bytecode).constructor(*args))
+    return w3.eth.contract(address=receipt['contractAddress'], abi=abi)
+
+
+def fund(w3, address, amount=Web3.to_wei(1000, 'ether')):
+    tx_hash = w3.eth.send_transaction({'from': w3.eth.accounts[0], 'to': address, 'value': amount})
+    w3.eth.wait_for_transaction_receipt(tx_hash)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_benchmark(oz_path, num_deposits=100, num_tokens=2, burst=None, batch=False):
+    """
+        Runs the benchmark and returns a dictionary of results
+        burst - deposits made between two relay scans (default: all of them at once)
+    """
+    compiled = compile_contracts(oz_path)
+    providers = {'source': CountingProvider(), 'destination': CountingProvider()}
+    chains = {chain: Web3(provider) for chain, provider in providers.items()}
+    src_w3, dst_w3 = chains['source'], chains['destination']
+
+    warden = eth_account.Account.create()
+    fund(src_w3, warden.address)
+    fund(dst_w3, warden.address)
+    depositor = src_w3.eth.accounts[0]
+
+    source = deploy(src_w3, warden, compiled, 'Source', warden.address)
+    destination = deploy(dst_w3, warden, compiled, 'Destination', warden.address)
+    tokens = []
+    for i in range(num_tokens):
+        token = deploy(src_w3, warden, compiled, 'BridgeToken', '0x' + '00' * 20, f"Token {i}", f"TK{i}", warden.address)
+        send_tx(src_w3, warden, token.functions.mint(depositor, 10 ** 30))
+        send_tx(src_w3, warden, source.functions.registerToken(token.address))
+        send_tx(dst_w3, warden, destination.functions.createToken(token.address, f"Wrapped {i}", f"W{i}"))
+        token.functions.approve(source.address, 2 ** 256 - 1).transact({'from': depositor})
+        tokens.append(token)
+
+    workdir = tempfile.mkdtemp()
+    contract_info = os.path.join(workdir, "contract_info.json")
+    with open(contract_info, 'w') as f:
+        json.dump({
+            'source': {'address': source.address, 'abi': source.abi},
+            'destination': {'address': destination.address, 'abi': destination.abi},
+        }, f)
+    cursor_db = os.path.join(workdir, "cursor.db")
+    conn = bridge.open_cursor_db(cursor_db)
+    bridge.set_cursor(conn, 'source', src_w3.eth.block_number)
+    conn.close()
+
+    # Point the bridge at the local chains and the local warden account
+    bridge.connect_to = lambda chain: chains[chain]
+    bridge.get_account = lambda: warden
+
+    for provider in providers.values():
+        provider.calls = 0
+    burst = burst or num_deposits
+    deposited_at = {}  # amount -> wall clock time the deposit was mined (amounts are unique per deposit)
+    relay_calls = 0
+    relay_time = 0
+    wrapped = 0
+    for start in range(0, num_deposits, burst):
+        for i in range(start, min(num_deposits, start + burst)):
+            amount = i + 1
+            recipient = src_w3.eth.accounts[1 + i % 9]
+            tx_hash = source.functions.deposit(tokens[i % num_tokens].address, recipient, amount).transact({'from': depositor})
+            src_w3.eth.wait_for_transaction_receipt(tx_hash)
+            deposited_at[amount] = time.time()
+
+        # Bury the deposits under enough blocks for the bridge to consider them confirmed
+        providers['source'].ethereum_tester.mine_blocks(bridge.CONFIRMATIONS['source'])
+
+        # Only the relay itself counts towards RPC calls and elapsed time
+        calls_before = sum(p.calls for p in providers.values())
+        started = time.time()
+        while wrapped < min(num_deposits, start + burst):
+            if time.time() - started > RELAY_TIMEOUT:
+                raise RuntimeError(f"Only {wrapped} of {num_deposits} deposits were wrapped")
+            bridge.scan_blocks('source', contract_info=contract_info, cursor_db=cursor_db, batch=batch)
+            # The progress check itself is not part of the relay's RPC calls
+            check_calls = providers['destination'].calls
+            wrapped = len(destination.events.Wrap.get_logs(from_block=0))
+            calls_before += providers['destination'].calls - check_calls
+        relay_time += time.time() - started
+        relay_calls += sum(p.calls for p in providers.values()) - calls_before
+
+    wrap_events = destination.events.Wrap.get_logs(from_block=0)
+    latencies = []
+    gas_used = 0
+    relay_txs = set()
+    for evt in wrap_events:
+        tx_hash = Web3.to_hex(evt.transactionHash)
+        latencies.append(providers['destination'].mined_at[tx_hash] - deposited_at[evt.args['amount']])
+        relay_txs.add(tx_hash)
+    for tx_hash in relay_txs:
+        gas_used += dst_w3.eth.get_transaction_receipt(tx_hash)['gasUsed']
+
+    return {
+        'deposits': num_deposits,
+        'batch': batch,
+        'events_per_sec': num_deposits / relay_time if relay_time > 0 else 0,
+        'rpc_calls_per_event': relay_calls / num_deposits,
+        'gas_per_event': gas_used / num_deposits,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'solc': SOLC_VERSION,
+        'contracts': contracts_hash(),
+    }
+
+
+def print_results(results, baseline=None):
+    for key, value in results.items():
+        line = f"{key:>22}: {value:.4f}" if isinstance(value, float) else f"{key:>22}: {value}"
+        if baseline is not None and isinstance(value, (int, float)) and not isinstance(value, bool) and baseline.get(key):
+            line += f"  ({(value - baseline[key]) / baseline[key] * 100:+.1f}% vs baseline)"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the bridge relay on a local EVM")
+    parser.add_argument('--oz', required=True, help="path to an openzeppelin-contracts checkout")
+    parser.add_argument('-n', '--deposits', type=int, default=100)
+    parser.add_argument('--tokens', type=int, default=2)
+    parser.add_argument('--burst', type=int, default=None, help="deposits between relay scans")
+    parser.add_argument('--batch', action='store_true', help="relay with batchWrap")
+    parser.add_argument('--out', help="write the results to this json file")
+    parser.add_argument('--baseline', help="json results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.oz, args.deposits, args.tokens, args.burst, args.batch)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('contracts') != results['contracts']:
+            print(f"Warning: the baseline was measured on other contract sources ({baseline.get('contracts')})")
+    print_results(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -1,26 +1,28 @@
 from web3 import Web3
-from web3.providers.rpc import HTTPProvider
-from web3.middleware import ExtraDataToPOAMiddleware #Necessary for POA chains
 from pathlib import Path
-import json
 from datetime import datetime
 import pandas as pd
 import eth_account
 import os
-import time
+import sqlite3
+from contextlib import closing
+from web3.exceptions import ContractLogicError
+import relayer
+import clients
+import logfetch
+import metrics
 
 
-def connect_to(chain):
-    if chain == 'source':  # The source contract chain is avax
-        api_url = f"https://api.avax-test.network/ext/bc/C/rpc" #AVAX C-chain testnet
+API_URLS = {
+    'source': "https://api.avax-test.network/ext/bc/C/rpc",  # The source contract chain is avax (C-chain testnet)
+    'destination': "https://data-seed-prebsc-1-s1.binance.org:8545/",  # The destination contract chain is bsc (testnet)
+}
 
-    if chain == 'destination':  # The destination contract chain is bsc
-        api_url = f"https://data-seed-prebsc-1-s1.binance.org:8545/" #BSC testnet
 
+def connect_to(chain):
     if chain in ['source','destination']:
-        w3 = Web3(Web3.HTTPProvider(api_url))
-        # inject the poa compatibility middleware to the innermost layer
-        w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+        # Shared instance with a pooled HTTP session and the poa middleware already injected
+        w3 = clients.get_web3(API_URLS[chain])
     return w3
 
 
@@ -30,9 +32,8 @@ def get_contract_info(chain, contract_info):
         This function is used by the autograder and will likely be useful to you
     """
     try:
-        # Handle both Path objects and strings (open() handles Path in Python 3.6+)
-        with open(contract_info, 'r')  as f:
-            contracts = json.load(f)
+        # Parsed once per process (and again only if the file changes)
+        contracts = clients.load_contract_info(contract_info)
     except Exception as e:
         print( f"Failed to read contract info\nPlease contact your instructor\n{e}" )
         return 0
@@ -40,19 +41,170 @@ def get_contract_info(chain, contract_info):
 
 
 
-def scan_blocks(chain, contract_info="contract_info.json"):
+SCAN_WINDOW = {'source': 5, 'destination': 15}  # Blocks to look back when there is no saved cursor
+SCAN_CHUNK_SIZE = 500  # Max blocks to scan in one request when catching up
+CONFIRMATIONS = {'source': 2, 'destination': 15}  # Blocks an event must be buried under before we relay it
+HASH_HISTORY = 64  # Recent (block number, hash) pairs kept per chain to detect reorgs
+CURSOR_DB = "bridge_cursor.db"
+RELAY_GAS = 300000  # Gas limit for a single wrap/withdraw when it cannot be estimated
+RECEIPT_TIMEOUT = 120  # Seconds to wait for outstanding relay receipts before exiting
+BATCH_BASE_GAS = 60000  # Fixed gas of a batchWrap/batchWithdraw call
+BATCH_GAS_PER_EVENT = 90000  # Extra gas for each event relayed in a batch
+BATCH_GAS_LIMIT = 3000000  # Largest batch transaction we are willing to send
+RELAY_ATTEMPTS = 3  # Times an event is relayed again after its relay transaction failed or was dropped
+
+
+def open_cursor_db(cursor_db=CURSOR_DB):
     """
-        chain - (string) should be either "source" or "destination"
-        Scan the last 5 blocks of the source and destination chains
-        Look for 'Deposit' events on the source chain and 'Unwrap' events on the destination chain
-        When Deposit events are found on the source chain, call the 'wrap' function the destination chain
-        When Unwrap events are found on the destination chain, call the 'withdraw' function on the source chain
+        Opens (and creates if needed) the SQLite file that stores the last
+        fully processed block for each chain
     """
+    conn = sqlite3.connect(cursor_db)
+    conn.execute("CREATE TABLE IF NOT EXISTS cursors (chain TEXT PRIMARY KEY, last_block INTEGER NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS block_hashes (chain TEXT NOT NULL, number INTEGER NOT NULL, hash TEXT NOT NULL, "
+                 "PRIMARY KEY (chain, number))")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(relayed)")]
+    if len(columns) > 0 and 'log_index' not in columns:
+        # Older files keyed relayed events by transaction only, their rows stand for every event of the transaction
+        conn.execute("ALTER TABLE relayed RENAME TO relayed_by_tx")
+    conn.execute("CREATE TABLE IF NOT EXISTS relayed (chain TEXT NOT NULL, tx_hash TEXT NOT NULL, log_index INTEGER NOT NULL, "
+                 "block_number INTEGER NOT NULL, PRIMARY KEY (chain, tx_hash, log_index))")
+    if len(columns) > 0 and 'log_index' not in columns:
+        conn.execute("INSERT INTO relayed (chain, tx_hash, log_index, block_number) "
+                     "SELECT chain, tx_hash, -1, block_number FROM relayed_by_tx")
+        conn.execute("DROP TABLE relayed_by_tx")
+    # Relayed events whose relay transaction has not been seen to succeed yet (relay_nonce NULL: to be relayed again)
+    conn.execute("CREATE TABLE IF NOT EXISTS pending_relays (chain TEXT NOT NULL, tx_hash TEXT NOT NULL, log_index INTEGER NOT NULL, "
+                 "block_number INTEGER NOT NULL, relay_nonce INTEGER, relay_tx TEXT, attempts INTEGER NOT NULL, "
+                 "PRIMARY KEY (chain, tx_hash, log_index))")
+    conn.commit()
+    return conn
 
-    if chain not in ['source','destination']:
-        print( f"Invalid chain: {chain}" )
-        return 0
-    
+
+def get_cursor(conn, chain):
+    """
+        Returns the last fully processed block for chain, or None if the chain has never been scanned
+    """
+    row = conn.execute("SELECT last_block FROM cursors WHERE chain = ?", (chain,)).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def set_cursor(conn, chain, block_num):
+    """
+        Records block_num as the last fully processed block for chain
+    """
+    with conn:
+        conn.execute("INSERT INTO cursors (chain, last_block) VALUES (?, ?) "
+                     "ON CONFLICT(chain) DO UPDATE SET last_block = excluded.last_block", (chain, block_num))
+
+
+def record_block_hash(conn, chain, number, block_hash):
+    """
+        Adds (number, block_hash) to the ring buffer of recent blocks for chain, keeping the newest HASH_HISTORY
+        Relayed transactions older than the ring buffer are forgotten, since we can no longer rewind that far
+    """
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO block_hashes (chain, number, hash) VALUES (?, ?, ?)", (chain, number, block_hash))
+        conn.execute("DELETE FROM block_hashes WHERE chain = ? AND number NOT IN "
+                     "(SELECT number FROM block_hashes WHERE chain = ? ORDER BY number DESC LIMIT ?)",
+                     (chain, chain, HASH_HISTORY))
+        conn.execute("DELETE FROM relayed WHERE chain = ? AND block_number < "
+                     "(SELECT MIN(number) FROM block_hashes WHERE chain = ?)", (chain, chain))
+
+
+def find_reorg(conn, chain, w3):
+    """
+        Compares the ring buffer of recent block hashes for chain with the chain itself
+        Returns None if the newest recorded block is still on the chain, otherwise the newest recorded
+        block that still matches (the range after it has to be scanned again), or the block before the
+        oldest recorded one if none match
+    """
+    rows = conn.execute("SELECT number, hash FROM block_hashes WHERE chain = ? ORDER BY number DESC", (chain,)).fetchall()
+    for i, (number, block_hash) in enumerate(rows):
+        if Web3.to_hex(w3.eth.get_block(number)['hash']) == block_hash:
+            return None if i == 0 else number
+    if len(rows) == 0:
+        return None
+    return rows[-1][0] - 1
+
+
+def unrelayed_events(conn, chain, events):
+    """
+        Returns the events that have not been relayed yet, matching them on transaction hash and log index
+        A reorg can move a transaction to another block and change the log index of its events, so relayed rows
+        of a transaction that match none of its events cover its first unmatched events
+    """
+    by_tx = {}
+    for evt in events:
+        by_tx.setdefault(Web3.to_hex(evt['transactionHash']), []).append(evt)
+    skipped = set()
+    for tx_hash, tx_events in by_tx.items():
+        rows = {row[0] for row in conn.execute("SELECT log_index FROM relayed WHERE chain = ? AND tx_hash = ?", (chain, tx_hash))}
+        # A row from before events were keyed by log index (-1) covers the whole transaction
+        if -1 in rows:
+            skipped.update(id(evt) for evt in tx_events)
+            continue
+        unmatched = len(rows - {evt['logIndex'] for evt in tx_events})
+        for evt in tx_events:
+            if evt['logIndex'] in rows:
+                skipped.add(id(evt))
+            elif unmatched > 0:
+                skipped.add(id(evt))
+                unmatched -= 1
+    return [evt for evt in events if id(evt) not in skipped]
+
+
+def mark_relayed(conn, chain, events):
+    """
+        Remembers events as relayed, so rescanning after a reorg or a failed range does not relay them twice
+        Rows are keyed by transaction hash and log index, since one transaction can emit several events
+    """
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO relayed (chain, tx_hash, log_index, block_number) VALUES (?, ?, ?, ?)",
+                         [(chain, Web3.to_hex(evt['transactionHash']), evt['logIndex'], evt['blockNumber']) for evt in events])
+
+
+def event_keys(chain, events):
+    return [(chain, Web3.to_hex(evt['transactionHash']), evt['logIndex']) for evt in events]
+
+
+def record_pending(conn, chain, events, relay_nonce, relay_tx):
+    """
+        Remembers that events were sent in relay_tx (with relay_nonce), until its receipt shows it succeeded
+        Rows left behind by a process that exited first are checked, and relayed again if needed, by retry_relays
+    """
+    with conn:
+        conn.executemany("INSERT INTO pending_relays (chain, tx_hash, log_index, block_number, relay_nonce, relay_tx, attempts) "
+                         "VALUES (?, ?, ?, ?, ?, ?, 0) ON CONFLICT(chain, tx_hash, log_index) DO UPDATE SET "
+                         "relay_nonce = excluded.relay_nonce, relay_tx = excluded.relay_tx",
+                         [key + (evt['blockNumber'], relay_nonce, Web3.to_hex(relay_tx))
+                          for key, evt in zip(event_keys(chain, events), events)])
+
+
+def clear_pending(conn, chain, events):
+    """
+        Forgets the relay transactions of events, once they succeeded or will never succeed
+    """
+    with conn:
+        conn.executemany("DELETE FROM pending_relays WHERE chain = ? AND tx_hash = ? AND log_index = ?", event_keys(chain, events))
+
+
+def requeue_events(conn, chain, events):
+    """
+        Marks events as not relayed, and queues them to be relayed again by retry_relays
+    """
+    with conn:
+        conn.executemany("DELETE FROM relayed WHERE chain = ? AND tx_hash = ? AND log_index = ?", event_keys(chain, events))
+        conn.executemany("UPDATE pending_relays SET relay_nonce = NULL, relay_tx = NULL "
+                         "WHERE chain = ? AND tx_hash = ? AND log_index = ?", event_keys(chain, events))
+
+
+def get_account():
+    """
+        Returns the bridge warden account recovered from secret_key.txt (or sk.txt)
+    """
     secret_key_file = None
     possible_paths = [
         "secret_key.txt",
@@ -70,11 +222,333 @@ def scan_blocks(chain, contract_info="contract_info.json"):
     
     if secret_key_file is None:
         print( f"Error: Could not find secret_key.txt or sk.txt in any of the expected locations" )
-        return 0
+        return None
     
     with open(secret_key_file, "r") as f:
         private_key = f.read().strip()
-    account = eth_account.Account.from_key(private_key)
+    return eth_account.Account.from_key(private_key)
+
+
+def get_events(contract, event_name, start_block, end_block):
+    """
+        Returns the event_name events emitted by contract between start_block and end_block (inclusive)
+    """
+    # Plain eth_getLogs with adaptive range splitting, no filter installed on the node
+    return logfetch.get_events(contract, event_name, start_block, end_block)
+
+
+def record_scan(chain, start_block, end_block, tip, events):
+    """
+        Updates the scan metrics after blocks start_block - end_block were scanned while the chain tip was tip
+    """
+    metrics.inc('bridge_blocks_scanned_total', end_block - start_block + 1, chain=chain)
+    metrics.inc('bridge_events_found_total', len(events), chain=chain)
+    metrics.set_gauge('bridge_last_scanned_block', end_block, chain=chain)
+    metrics.set_gauge('bridge_scan_lag_blocks', tip - end_block, chain=chain)
+
+
+def make_batches(items, base_gas=BATCH_BASE_GAS, gas_per_item=BATCH_GAS_PER_EVENT, gas_limit=BATCH_GAS_LIMIT):
+    """
+        Splits items into consecutive batches whose estimated gas (base_gas + gas_per_item per item)
+        stays under gas_limit
+        Returns a list of (batch, gas) pairs
+    """
+    max_items = max(1, (gas_limit - base_gas) // gas_per_item)
+    batches = []
+    for i in range(0, len(items), max_items):
+        batch = items[i:i + max_items]
+        batches.append((batch, base_gas + gas_per_item * len(batch)))
+    return batches
+
+
+def relay_events(chain, events, account, contract_info="contract_info.json", batch=False, conn=None, tip=None):
+    """
+        chain - (string) the chain the events were found on
+        For Deposit events found on the source chain, call 'wrap' on the destination chain
+        For Unwrap events found on the destination chain, call 'withdraw' on the source chain
+        batch - if True, group the events into 'batchWrap'/'batchWithdraw' calls capped by BATCH_GAS_LIMIT
+        conn - (optional) cursor database connection, the events of each relay transaction are marked relayed
+               in it as soon as the transaction is sent, so a failure part way through does not relay them again
+        tip - (optional) the tip of chain when the events were scanned, reported as bridge_relay_lag_blocks
+        Returns 1 if every relay transaction was submitted, 0 otherwise
+        Does not wait for receipts, they are reported (and stuck transactions replaced) by relayer.get_tracker,
+        see the wait argument of scan_blocks
+    """
+    if len(events) == 0:
+        return 1
+
+    other_chain = 'destination' if chain == 'source' else 'source'
+
+    # Get the contract info for the chain we are relaying to
+    other_contracts_data = get_contract_info(other_chain, contract_info)
+    if other_contracts_data == 0:
+        return 0
+    
+    # Connect to the other chain
+    other_w3 = connect_to(other_chain)
+    other_contract = clients.get_contract(other_w3, other_contracts_data["address"], other_contracts_data["abi"])
+
+    # Build every relay call first, then send them back-to-back with locally tracked nonces
+    if chain == 'source':
+        args = [(evt['args']['token'], evt['args']['recipient'], evt['args']['amount']) for evt in events]
+        for token, recipient, amount in args:
+            print(f"Processing Deposit: token={token}, recipient={recipient}, amount={amount}")
+        single_fn = other_contract.functions.wrap
+        batch_fn = other_contract.functions.batchWrap
+    else:
+        # For each Unwrap event, call withdraw() on source contract
+        args = [(evt['args']['underlying_token'], evt['args']['to'], evt['args']['amount']) for evt in events]
+        for underlying_token, to, amount in args:
+            print(f"Processing Unwrap: token={underlying_token}, to={to}, amount={amount}")
+        single_fn = other_contract.functions.withdraw
+        batch_fn = other_contract.functions.batchWithdraw
+
+    if batch:
+        # Each call carries a batch of events, tx_events[i] is the list of events sent in tx_hashes[i] and
+        # tx_args[i] their call arguments
+        batches = make_batches(list(zip(events, args)))
+        calls = []
+        gas = []
+        tx_events = []
+        tx_args = []
+        for batch_items, batch_gas in batches:
+            tokens, recipients, amounts = [list(col) for col in zip(*[call_args for _, call_args in batch_items])]
+            calls.append(batch_fn(tokens, recipients, amounts))
+            gas.append(batch_gas)
+            tx_events.append([evt for evt, _ in batch_items])
+            tx_args.append([call_args for _, call_args in batch_items])
+    else:
+        calls = [single_fn(*call_args) for call_args in args]
+        gas = None  # Cached estimate per (function, token)
+        tx_events = [[evt] for evt in events]
+        tx_args = [[call_args] for call_args in args]
+
+    event_w3 = connect_to(chain)
+    block_times = {}  # (chain, block number) -> timestamp
+
+    def block_time(w3, block_chain, block_num):
+        if (block_chain, block_num) not in block_times:
+            block_times[(block_chain, block_num)] = w3.eth.get_block(block_num)['timestamp']
+        return block_times[(block_chain, block_num)]
+
+    def record_lag(evt, receipt):
+        # Lag from the block the event was emitted in, to the block its relay was mined in
+        relay_time = block_time(other_w3, other_chain, receipt['blockNumber'])
+        metrics.set_gauge('bridge_relay_lag_seconds', relay_time - block_time(event_w3, chain, evt['blockNumber']), chain=chain)
+        if tip is not None:
+            metrics.set_gauge('bridge_relay_lag_blocks', tip - evt['blockNumber'], chain=chain)
+
+    # The tracker callbacks run on the tracker thread, which opens its own connections to the cursor database
+    db_path = None if conn is None else conn.execute("PRAGMA database_list").fetchone()[2]
+
+    def recorder(db, first=0):
+        def on_sent(i, tx_hash, nonce):
+            mark_relayed(db, chain, tx_events[first + i])
+            record_pending(db, chain, tx_events[first + i], nonce, tx_hash)
+        return on_sent
+
+    def on_confirmed(i, tx_hash, receipt):
+        metrics.inc('bridge_events_relayed_total', len(tx_events[i]), chain=chain)
+        if db_path is not None:
+            with closing(open_cursor_db(db_path)) as db:
+                clear_pending(db, chain, tx_events[i])
+        try:
+            record_lag(tx_events[i][-1], receipt)
+        except Exception as e:
+            metrics.inc('bridge_rpc_errors_total', chain=chain)
+            print(f"Error measuring relay lag: {e}")
+        for evt in tx_events[i]:
+            if chain == 'source':
+                print(f"Wrapped {evt['args']['amount']} tokens for {evt['args']['recipient']} on destination chain. Tx: {tx_hash.hex()}")
+            else:
+                print(f"Withdrew {evt['args']['amount']} tokens to {evt['args']['to']} on source chain. Tx: {tx_hash.hex()}")
+
+    def reverts(call_args):
+        # Only a revert of the call itself is permanent, an RPC error leaves the event to be relayed again
+        try:
+            single_fn(*call_args).call({'from': account.address})
+        except Exception as e:
+            # Not every provider raises ContractLogicError for a revert (eth-tester has its own exception)
+            return isinstance(e, ContractLogicError) or "execution reverted" in str(e)
+        return False
+
+    def on_failed(i, tx_hash, receipt):
+        if receipt is not None and len(tx_events[i]) > 1:
+            # A single reverting event reverts the whole batch, so the events are relayed again one by one
+            print(f"Batch relay of {len(tx_events[i])} events reverted, relaying them one at a time. Tx: {tx_hash.hex()}")
+            resend(i)
+            return
+        metrics.inc('bridge_relay_failures_total', len(tx_events[i]), chain=chain)
+        for evt in tx_events[i]:
+            print(f"Failed to relay {evt['event']} of {evt['args']['amount']} tokens. Tx: {tx_hash.hex()}")
+        if db_path is None:
+            return
+        if receipt is None:
+            # Given up on after max_replacements, but it may still be mined. retry_relays checks it on the next scan
+            return
+        with closing(open_cursor_db(db_path)) as db:
+            if reverts(tx_args[i][0]):
+                clear_pending(db, chain, tx_events[i])
+            else:
+                # E.g. out of gas, or the state changed since it was sent
+                requeue_events(db, chain, tx_events[i])
+
+    def resend(i):
+        # Runs on the tracker thread. Events that revert on their own are only checked with call(), not sent
+        first = len(tx_events)
+        single_calls = []
+        permanent = []
+        for evt, call_args in zip(tx_events[i], tx_args[i]):
+            if reverts(call_args):
+                metrics.inc('bridge_relay_failures_total', chain=chain)
+                print(f"Failed to relay {evt['event']} of {evt['args']['amount']} tokens, it reverts")
+                permanent.append(evt)
+                continue
+            single_calls.append(single_fn(*call_args))
+            tx_events.append([evt])
+            tx_args.append([call_args])
+        db = None if db_path is None else open_cursor_db(db_path)
+        record = None if db is None else recorder(db, first)
+        sent = set()
+
+        def on_sent(j, tx_hash, nonce):
+            sent.add(j)
+            if record is not None:
+                record(j, tx_hash, nonce)
+
+        try:
+            if db is not None:
+                clear_pending(db, chain, permanent)
+            if len(single_calls) == 0:
+                return
+            relayer.send_batch(other_w3, other_chain, account, single_calls, tracker=tracker, default_gas=RELAY_GAS,
+                               on_confirmed=lambda j, h, r: on_confirmed(first + j, h, r),
+                               on_failed=lambda j, h, r: on_failed(first + j, h, r), on_sent=on_sent)
+        except Exception as e:
+            metrics.inc('bridge_rpc_errors_total', chain=other_chain)
+            print(f"Error relaying the events of a reverted batch one at a time: {e}")
+            if db is not None:
+                # The events that were not sent are relayed again by the next scan
+                requeue_events(db, chain, [tx_events[first + j][0] for j in range(len(single_calls)) if j not in sent])
+        finally:
+            if db is not None:
+                db.close()
+
+    # Receipts are polled in the background by the process-wide tracker for the other chain, together with
+    # those of earlier ranges, and stuck transactions are re-sent with higher fees without holding up the scan
+    tracker = relayer.get_tracker(other_w3, other_chain, account)
+    try:
+        tx_hashes = relayer.send_batch(other_w3, other_chain, account, calls, gas=gas, tracker=tracker,
+                                       on_confirmed=on_confirmed, on_failed=on_failed, default_gas=RELAY_GAS,
+                                       on_sent=None if conn is None else recorder(conn))
+    except Exception:
+        metrics.inc('bridge_rpc_errors_total', chain=other_chain)
+        raise
+    for tx_hash in tx_hashes:
+        print(f"Sent {other_chain} relay transaction: {tx_hash.hex()}")
+
+    return 1
+
+
+def retry_relays(conn, chain, contract, event_name, account, contract_info, batch, tip=None):
+    """
+        Relays again the events in pending_relays that need it: those whose relay transaction failed without
+        reverting for good, and those left unresolved by an earlier process whose transaction has since been
+        dropped (see relayer.transaction_state). Each event is retried at most RELAY_ATTEMPTS times
+        Returns 1 if every retry was submitted (or there was nothing to retry), 0 otherwise
+    """
+    rows = conn.execute("SELECT tx_hash, log_index, block_number, relay_nonce, relay_tx, attempts FROM pending_relays "
+                        "WHERE chain = ?", (chain,)).fetchall()
+    if len(rows) == 0:
+        return 1
+
+    other_chain = 'destination' if chain == 'source' else 'source'
+    other_w3 = connect_to(other_chain)
+    tracker = relayer.get_tracker(other_w3, other_chain, account)
+    due = {}  # (tx hash, log index) -> block number
+    try:
+        for tx_hash, log_index, block_number, relay_nonce, relay_tx, attempts in rows:
+            if relay_nonce is not None:
+                # Still watched by this process, or sent by an earlier one and not resolved yet
+                if tracker.tracking(relay_nonce):
+                    continue
+                state = relayer.transaction_state(other_w3, account.address, relay_nonce, relay_tx)
+                if state == 'pending':
+                    continue
+                if state == 'confirmed':
+                    with conn:
+                        conn.execute("DELETE FROM pending_relays WHERE chain = ? AND tx_hash = ? AND log_index = ?",
+                                     (chain, tx_hash, log_index))
+                    continue
+            if attempts >= RELAY_ATTEMPTS:
+                metrics.inc('bridge_relay_failures_total', chain=chain)
+                print(f"Giving up on relaying event {log_index} of {tx_hash} after {attempts} attempts")
+                with conn:
+                    conn.execute("DELETE FROM pending_relays WHERE chain = ? AND tx_hash = ? AND log_index = ?",
+                                 (chain, tx_hash, log_index))
+                continue
+            due[(tx_hash, log_index)] = block_number
+
+        events = []
+        for block_number in sorted(set(due.values())):
+            events += [evt for evt in get_events(contract, event_name, block_number, block_number)
+                       if (Web3.to_hex(evt['transactionHash']), evt['logIndex']) in due]
+    except Exception as e:
+        metrics.inc('bridge_rpc_errors_total', chain=chain)
+        print(f"Error checking failed relays: {e}")
+        return 0
+
+    found = {(Web3.to_hex(evt['transactionHash']), evt['logIndex']) for evt in events}
+    with conn:
+        for key in due:
+            if key not in found:
+                # Moved by a reorg, the rescan of the reorged range relays it again since it is no longer marked relayed
+                print(f"Event {key[1]} of {key[0]} is no longer in block {due[key]}, not retrying it")
+                conn.execute("DELETE FROM relayed WHERE chain = ? AND tx_hash = ? AND log_index = ?", (chain,) + key)
+                conn.execute("DELETE FROM pending_relays WHERE chain = ? AND tx_hash = ? AND log_index = ?", (chain,) + key)
+        conn.executemany("UPDATE pending_relays SET attempts = attempts + 1 WHERE chain = ? AND tx_hash = ? AND log_index = ?",
+                         event_keys(chain, events))
+    if len(events) == 0:
+        return 1
+    print(f"Relaying {len(events)} {event_name} events again")
+    requeue_events(conn, chain, events)
+    return relay_events(chain, events, account, contract_info, batch=batch, conn=conn, tip=tip)
+
+
+def scan_blocks(chain, contract_info="contract_info.json", cursor_db=None, chunk_size=SCAN_CHUNK_SIZE, batch=False,
+                metrics_file=None, wait=True):
+    """
+        chain - (string) should be either "source" or "destination"
+        Scan the last 5 blocks of the source and destination chains
+        Look for 'Deposit' events on the source chain and 'Unwrap' events on the destination chain
+        When Deposit events are found on the source chain, call the 'wrap' function the destination chain
+        When Unwrap events are found on the destination chain, call the 'withdraw' function on the source chain
+
+        cursor_db - (optional) path to a SQLite file holding the last fully processed block per chain
+        When cursor_db is given, scanning resumes after the saved block and catches up to the chain tip
+        in ranges of at most chunk_size blocks. The cursor only moves past a range once the relay
+        transactions for that range have been submitted
+
+        batch - if True, relay with 'batchWrap'/'batchWithdraw' instead of one transaction per event
+
+        Only blocks at least CONFIRMATIONS[chain] deep are scanned. In cursor mode the hashes of recently
+        scanned blocks are kept, and if they no longer match the chain the cursor is rewound to the last
+        matching block and only the range after it is scanned again. Events whose relay transaction failed
+        (without reverting for good) or was dropped are relayed again first, see retry_relays
+
+        metrics_file - (optional) file to write Prometheus metrics (scan/relay counters and lag) to when done
+
+        wait - if True, wait up to RECEIPT_TIMEOUT for the receipts of every relay transaction before returning,
+               so they are reported (and stuck ones replaced) before a one-shot process exits
+    """
+
+    if chain not in ['source','destination']:
+        print( f"Invalid chain: {chain}" )
+        return 0
+    
+    account = get_account()
+    if account is None:
+        return 0
     
     # Get contract info for the current chain
     contracts_data = get_contract_info(chain, contract_info)
@@ -83,125 +557,90 @@ def scan_blocks(chain, contract_info="contract_info.json"):
     
     # Connect to the chain and get contract
     w3 = connect_to(chain)
-    contract_address = Web3.to_checksum_address(contracts_data["address"])
-    contract_abi = contracts_data["abi"]
-    contract = w3.eth.contract(address=contract_address, abi=contract_abi)
-    
-    if chain == 'source':
-        # Scan the last 5 blocks on source chain
-        end_block = w3.eth.get_block_number()
-        start_block = max(1, end_block - 5)
-        
-        print(f"Scanning source blocks {start_block} - {end_block}")
-        
-        # Look for Deposit events on source chain
-        all_events = []
+    contract = clients.get_contract(w3, contracts_data["address"], contracts_data["abi"])
+
+    event_name = 'Deposit' if chain == 'source' else 'Unwrap'
+    try:
+        return scan_range(chain, w3, contract, event_name, account, contract_info, cursor_db, chunk_size, batch)
+    finally:
+        # The trackers poll on daemon threads, which stop with the process
+        if wait and not relayer.wait_for_trackers(RECEIPT_TIMEOUT):
+            print(f"Relay transactions still pending after {RECEIPT_TIMEOUT}s")
+        if metrics_file is not None:
+            metrics.write(metrics_file)
+
+
+def scan_range(chain, w3, contract, event_name, account, contract_info, cursor_db, chunk_size, batch, tip=None, stop=None):
+    """
+        Scans chain up to its tip (see scan_blocks) and relays the events found
+        tip - (optional) the chain tip, if the caller already knows it
+        stop - (optional) event checked between ranges, scanning ends early (keeping the cursor) once it is set
+    """
+    if tip is None:
+        tip = w3.eth.get_block_number()
+    # Only blocks with enough confirmations are scanned, so a shallow reorg cannot remove an event we relayed
+    end_block = tip - CONFIRMATIONS[chain]
+
+    if cursor_db is None:
+        start_block = max(1, end_block - SCAN_WINDOW[chain])
+        print(f"Scanning {chain} blocks {start_block} - {end_block}")
+
+        # Look for Deposit events on source chain, or Unwrap events on the destination chain
         try:
-            event_filter = contract.events.Deposit.create_filter(
-                from_block=start_block, 
-                to_block=end_block
-            )
-            events = event_filter.get_all_entries()
-            all_events.extend(events)
+            events = get_events(contract, event_name, start_block, end_block)
+            record_scan(chain, start_block, end_block, end_block, events)
         except Exception as e:
-            print(f"Error scanning for Deposit events: {e}")
-            all_events = []
-        
-        events = all_events
-        print(f"Found {len(events)} Deposit events")
-        
-        if len(events) > 0:
-            # Get destination contract info
-            dest_contracts_data = get_contract_info("destination", contract_info)
-            if dest_contracts_data == 0:
+            metrics.inc('bridge_rpc_errors_total', chain=chain)
+            print(f"Error scanning for {event_name} events: {e}")
+            events = []
+        print(f"Found {len(events)} {event_name} events")
+
+        return relay_events(chain, events, account, contract_info, batch=batch, tip=tip)
+
+    conn = open_cursor_db(cursor_db)
+    try:
+        last_block = get_cursor(conn, chain)
+        if last_block is None:
+            # First run, start from the same window as the one-shot scan
+            last_block = max(0, end_block - SCAN_WINDOW[chain] - 1)
+        else:
+            safe_block = find_reorg(conn, chain, w3)
+            if safe_block is not None and safe_block < last_block:
+                print(f"Reorg detected on {chain}, rescanning from block {safe_block + 1}")
+                last_block = safe_block
+                set_cursor(conn, chain, last_block)
+
+        if retry_relays(conn, chain, contract, event_name, account, contract_info, batch, tip) == 0:
+            return 0
+
+        while last_block < end_block:
+            if stop is not None and stop.is_set():
+                break
+            start_block = last_block + 1
+            chunk_end = min(end_block, start_block + chunk_size - 1)
+            print(f"Scanning {chain} blocks {start_block} - {chunk_end}")
+
+            try:
+                # The hash is read before the logs, so a reorg in between shows up as a mismatch on the next run
+                chunk_end_hash = Web3.to_hex(w3.eth.get_block(chunk_end)['hash'])
+                events = get_events(contract, event_name, start_block, chunk_end)
+            except Exception as e:
+                metrics.inc('bridge_rpc_errors_total', chain=chain)
+                print(f"Error scanning for {event_name} events: {e}")
                 return 0
-            
-            # Connect to destination chain
-            dest_w3 = connect_to("destination")
-            dest_contract_address = Web3.to_checksum_address(dest_contracts_data["address"])
-            dest_contract_abi = dest_contracts_data["abi"]
-            dest_contract = dest_w3.eth.contract(address=dest_contract_address, abi=dest_contract_abi)
-            
-           
-            for evt in events:
-                token = evt['args']['token']
-                recipient = evt['args']['recipient']
-                amount = evt['args']['amount']
-                
-                print(f"Processing Deposit: token={token}, recipient={recipient}, amount={amount}")
-                
-                # Build and send wrap transaction
-                nonce = dest_w3.eth.get_transaction_count(account.address, 'pending')
-                transaction = dest_contract.functions.wrap(token, recipient, amount).build_transaction({
-                    'from': account.address,
-                    'nonce': nonce,
-                    'gas': 300000,
-                    'gasPrice': dest_w3.eth.gas_price,
-                })
-                
-                signed_txn = dest_w3.eth.account.sign_transaction(transaction, account.key)
-                tx_hash = dest_w3.eth.send_raw_transaction(signed_txn.raw_transaction)
-                
-                print(f"Sent wrap transaction: {tx_hash.hex()}")
-    
-    elif chain == 'destination':
-
-        end_block = w3.eth.get_block_number()
-        start_block = max(1, end_block - 15)  
-        
-        print(f"Scanning destination blocks {start_block} - {end_block}")
-        
-        all_events = []
-        try:
-            event_filter = contract.events.Unwrap.create_filter(
-                from_block=start_block, 
-                to_block=end_block
-            )
-            events = event_filter.get_all_entries()
-            all_events.extend(events)
-        except Exception as e:
-            print(f"Error scanning for Unwrap events: {e}")
-            all_events = []
-        
-        events = all_events
-        print(f"Found {len(events)} Unwrap events")
-        
-        if len(events) > 0:
-            # Get source contract info
-            source_contracts_data = get_contract_info("source", contract_info)
-            if source_contracts_data == 0:
+            record_scan(chain, start_block, chunk_end, end_block, events)
+            print(f"Found {len(events)} {event_name} events")
+
+            # Events re-included after a reorg keep their transaction hash, and may already have been relayed
+            events = unrelayed_events(conn, chain, events)
+            # Events are marked relayed as each transaction is sent, the cursor only moves once all of them are
+            if relay_events(chain, events, account, contract_info, batch=batch, conn=conn, tip=tip) == 0:
                 return 0
-            
-            # Connect to source chain
-            source_w3 = connect_to("source")
-            source_contract_address = Web3.to_checksum_address(source_contracts_data["address"])
-            source_contract_abi = source_contracts_data["abi"]
-            source_contract = source_w3.eth.contract(address=source_contract_address, abi=source_contract_abi)
-            
-            # For each Unwrap event, call withdraw() on source contract
-            for evt in events:
-                underlying_token = evt['args']['underlying_token']
-                to = evt['args']['to']
-                amount = evt['args']['amount']
-                
-                print(f"Processing Unwrap: token={underlying_token}, to={to}, amount={amount}")
-                
-                # Build and send withdraw transaction
-                nonce = source_w3.eth.get_transaction_count(account.address, 'pending')
-                transaction = source_contract.functions.withdraw(underlying_token, to, amount).build_transaction({
-                    'from': account.address,
-                    'nonce': nonce,
-                    'gas': 300000,
-                    'gasPrice': source_w3.eth.gas_price,
-                })
-                
-                signed_txn = source_w3.eth.account.sign_transaction(transaction, account.key)
-                tx_hash = source_w3.eth.send_raw_transaction(signed_txn.raw_transaction)
-                receipt = source_w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-                
-                if receipt['status'] == 1:
-                    print(f"Withdrew {amount} tokens to {to} on source chain. Tx: {tx_hash.hex()}")
-                else:
-                    print(f"Failed to withdraw {amount} tokens. Tx: {tx_hash.hex()}")
-    
+
+            record_block_hash(conn, chain, chunk_end, chunk_end_hash)
+            set_cursor(conn, chain, chunk_end)
+            last_block = chunk_end
+    finally:
+        conn.close()
+
     return 1
@@ -0,0 +1,124 @@
+from web3 import AsyncWeb3
+from web3.middleware import ExtraDataToPOAMiddleware #Necessary for POA chains
+import asyncio
+import signal
+import bridge
+import clients
+import metrics
+import relayer
+
+
+POLL_INTERVAL = 2  # Seconds to wait between checks for new blocks on each chain
+
+
+def connect_async(chain):
+    """
+        Returns an AsyncWeb3 instance connected to chain ('source' or 'destination')
+    """
+    w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(bridge.API_URLS[chain]))
+    # inject the poa compatibility middleware to the innermost layer
+    w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+    return w3
+
+
+class Relay:
+    """
+        Shared state for the daemon: the warden account, and for each chain a connection to poll the tip
+        with, plus the synchronous connection and contract the shared scan/relay code in bridge uses
+        Fees, nonces, batching, receipt tracking, reorg handling and the relayed-event records are all
+        the same as for bridge.scan_blocks
+    """
+    def __init__(self, account, contract_info="contract_info.json", batch=False):
+        self.account = account
+        self.contract_info = contract_info
+        self.batch = batch
+        self.w3 = {}
+        self.sync_w3 = {}
+        self.contracts = {}
+
+    def connect(self):
+        """
+            Connects to both chains and loads their contracts
+            Returns 0 (without connecting) if the contract info cannot be read, 1 otherwise
+        """
+        contracts_data = {}
+        for chain in ['source', 'destination']:
+            contracts_data[chain] = bridge.get_contract_info(chain, self.contract_info)
+            if contracts_data[chain] == 0:
+                return 0
+        for chain in ['source', 'destination']:
+            self.w3[chain] = connect_async(chain)
+            self.sync_w3[chain] = bridge.connect_to(chain)
+            self.contracts[chain] = clients.get_contract(self.sync_w3[chain], contracts_data[chain]["address"],
+                                                         contracts_data[chain]["abi"])
+        return 1
+
+    async def disconnect(self):
+        """
+            Closes the HTTP sessions of the async connections
+        """
+        for w3 in self.w3.values():
+            await w3.provider.disconnect()
+
+    async def watch(self, chain, stop, cursor_db=bridge.CURSOR_DB, chunk_size=bridge.SCAN_CHUNK_SIZE,
+                    poll_interval=POLL_INTERVAL):
+        """
+            Follows chain until stop is set, relaying new events and saving progress in cursor_db
+            Each new tip is handed to bridge.scan_range in a worker thread, so both chains are scanned at once
+        """
+        event_name = 'Deposit' if chain == 'source' else 'Unwrap'
+        last_tip = None
+        while not stop.is_set():
+            try:
+                tip = await self.w3[chain].eth.get_block_number()
+                if tip != last_tip:
+                    # scan_range checks stop between ranges, so shutdown only waits for the current range
+                    await asyncio.to_thread(bridge.scan_range, chain, self.sync_w3[chain], self.contracts[chain],
+                                            event_name, self.account, self.contract_info, cursor_db, chunk_size,
+                                            self.batch, tip=tip, stop=stop)
+                    last_tip = tip
+            except Exception as e:
+                metrics.inc('bridge_rpc_errors_total', chain=chain)
+                print(f"Error scanning {chain}: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def run(contract_info="contract_info.json", cursor_db=bridge.CURSOR_DB, batch=False, poll_interval=POLL_INTERVAL,
+              metrics_port=None):
+    """
+        Watches the source and destination chains at the same time until SIGINT/SIGTERM,
+        then finishes the current range and waits for outstanding receipts before exiting
+        metrics_port - (optional) port to serve Prometheus metrics on
+    """
+    account = bridge.get_account()
+    if account is None:
+        return 0
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+
+    relay = Relay(account, contract_info, batch=batch)
+    if relay.connect() == 0:
+        return 0
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await asyncio.gather(
+            relay.watch('source', stop, cursor_db, poll_interval=poll_interval),
+            relay.watch('destination', stop, cursor_db, poll_interval=poll_interval),
+        )
+        if not await asyncio.to_thread(relayer.wait_for_trackers, bridge.RECEIPT_TIMEOUT):
+            print(f"Relay transactions still pending after {bridge.RECEIPT_TIMEOUT}s")
+    finally:
+        await relay.disconnect()
+    print("Bridge daemon stopped")
+    return 1
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
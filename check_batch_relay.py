@@ -0,0 +1,147 @@
+"""
+    Behaviour check of the batched relay on two local in-process EVMs (eth-tester/py-evm)
+
+    Deploys Source.sol, Destination.sol and BridgeToken.sol like bench_bridge.py and checks
+      - a batchWrap round trip: deposits on the source are relayed with bridge.scan_blocks(batch=True)
+      - a batchWithdraw round trip: unwraps on the destination are relayed back the same way
+      - batchWrap/batchWithdraw revert when their argument lists have different lengths
+      - when a batch reverts, its events fall back to single relays and only the bad event is dropped
+
+    Needs web3[tester] and py-solc-x, and a checkout of openzeppelin-contracts for the imports, e.g.
+        python check_batch_relay.py --oz ../openzeppelin-contracts
+    Exits with status 1 if any check fails
+"""
+from web3 import Web3
+import argparse
+import json
+import os
+import sys
+import tempfile
+import eth_account
+import bridge
+from bench_bridge import CountingProvider, compile_contracts, deploy, fund, send_tx
+
+
+failures = []
+
+
+def check(condition, message):
+    print(f"{'ok' if condition else 'FAILED'}: {message}")
+    if not condition:
+        failures.append(message)
+
+
+def reverts(w3, account, fn):
+    """
+        Returns True if calling fn from account reverts
+    """
+    try:
+        fn.call({'from': account.address})
+    except Exception as e:
+        print(f"    reverted: {e}")
+        return True
+    return False
+
+
+def relay(chain, contract_info, cursor_db, providers):
+    # Bury the events under enough blocks for the bridge to consider them confirmed
+    providers[chain].ethereum_tester.mine_blocks(bridge.CONFIRMATIONS[chain])
+    return bridge.scan_blocks(chain, contract_info=contract_info, cursor_db=cursor_db, batch=True)
+
+
+def run_checks(oz_path):
+    compiled = compile_contracts(oz_path)
+    providers = {'source': CountingProvider(), 'destination': CountingProvider()}
+    chains = {chain: Web3(provider) for chain, provider in providers.items()}
+    src_w3, dst_w3 = chains['source'], chains['destination']
+
+    warden = eth_account.Account.create()
+    fund(src_w3, warden.address)
+    fund(dst_w3, warden.address)
+    depositor = src_w3.eth.accounts[0]
+    recipient = src_w3.eth.accounts[1]
+
+    source = deploy(src_w3, warden, compiled, 'Source', warden.address)
+    destination = deploy(dst_w3, warden, compiled, 'Destination', warden.address)
+    tokens = []
+    for i in range(2):
+        token = deploy(src_w3, warden, compiled, 'BridgeToken', '0x' + '00' * 20, f"Token {i}", f"TK{i}", warden.address)
+        send_tx(src_w3, warden, token.functions.mint(depositor, 10 ** 30))
+        send_tx(src_w3, warden, source.functions.registerToken(token.address))
+        token.functions.approve(source.address, 2 ** 256 - 1).transact({'from': depositor})
+        tokens.append(token)
+    # The second token is only registered on the source, so wrapping it reverts on the destination
+    good, missing = tokens
+    send_tx(dst_w3, warden, destination.functions.createToken(good.address, "Wrapped 0", "W0"))
+
+    workdir = tempfile.mkdtemp()
+    contract_info = os.path.join(workdir, "contract_info.json")
+    with open(contract_info, 'w') as f:
+        json.dump({
+            'source': {'address': source.address, 'abi': source.abi},
+            'destination': {'address': destination.address, 'abi': destination.abi},
+        }, f)
+    cursor_db = os.path.join(workdir, "cursor.db")
+    conn = bridge.open_cursor_db(cursor_db)
+    bridge.set_cursor(conn, 'source', src_w3.eth.block_number)
+    bridge.set_cursor(conn, 'destination', dst_w3.eth.block_number)
+    conn.close()
+
+    # Point the bridge at the local chains and the local warden account
+    bridge.connect_to = lambda chain: chains[chain]
+    bridge.get_account = lambda: warden
+
+    print("Length mismatch")
+    check(reverts(dst_w3, warden, destination.functions.batchWrap([good.address, good.address], [recipient], [1, 2])),
+          "batchWrap reverts on a length mismatch")
+    check(reverts(src_w3, warden, source.functions.batchWithdraw([good.address, good.address], [recipient], [1, 2])),
+          "batchWithdraw reverts on a length mismatch")
+
+    print("batchWrap round trip")
+    amounts = [10, 20, 30]
+    for amount in amounts:
+        source.functions.deposit(good.address, recipient, amount).transact({'from': depositor})
+    relay('source', contract_info, cursor_db, providers)
+    wraps = destination.events.Wrap.get_logs(from_block=0)
+    check(sorted(evt.args['amount'] for evt in wraps) == amounts, "every deposit is wrapped")
+    check(len({evt.transactionHash for evt in wraps}) == 1, "the deposits are wrapped in one batchWrap transaction")
+
+    print("batchWithdraw round trip")
+    wrapped = destination.functions.wrapped_tokens(good.address).call()
+    balance = good.functions.balanceOf(recipient).call()
+    for amount in [5, 15]:
+        destination.functions.unwrap(wrapped, recipient, amount).transact({'from': recipient})
+    relay('destination', contract_info, cursor_db, providers)
+    withdrawals = source.events.Withdrawal.get_logs(from_block=0)
+    check(sorted(evt.args['amount'] for evt in withdrawals) == [5, 15], "every unwrap is withdrawn")
+    check(len({evt.transactionHash for evt in withdrawals}) == 1, "the unwraps are withdrawn in one batchWithdraw transaction")
+    check(good.functions.balanceOf(recipient).call() == balance + 20, "the recipient gets the underlying tokens back")
+
+    print("Fallback to single relays")
+    wrapped_before = len(destination.events.Wrap.get_logs(from_block=0))
+    for token, amount in [(good, 41), (missing, 42), (good, 43)]:
+        source.functions.deposit(token.address, recipient, amount).transact({'from': depositor})
+    relay('source', contract_info, cursor_db, providers)
+    wraps = destination.events.Wrap.get_logs(from_block=0)[wrapped_before:]
+    check(sorted(evt.args['amount'] for evt in wraps) == [41, 43], "the good deposits of a reverted batch are wrapped one by one")
+    check(len({evt.transactionHash for evt in wraps}) == 2, "each fallback relay is its own transaction")
+    conn = bridge.open_cursor_db(cursor_db)
+    pending = conn.execute("SELECT COUNT(*) FROM pending_relays").fetchone()[0]
+    conn.close()
+    check(pending == 0, "the deposit that can never be wrapped is not retried")
+
+    # A second scan must not relay anything again
+    relay('source', contract_info, cursor_db, providers)
+    check(len(destination.events.Wrap.get_logs(from_block=0)) == wrapped_before + 2, "nothing is relayed twice")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the batched bridge relay on a local EVM")
+    parser.add_argument('--oz', required=True, help="path to an openzeppelin-contracts checkout")
+    args = parser.parse_args()
+
+    run_checks(args.oz)
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print("All checks passed")
@@ -0,0 +1,71 @@
+from web3 import Web3
+from web3.middleware import ExtraDataToPOAMiddleware #Necessary for POA chains
+from pathlib import Path
+import json
+import requests
+from requests.adapters import HTTPAdapter
+
+
+POOL_SIZE = 16  # Keep-alive connections kept open per RPC host
+
+_session = None
+_web3 = {}  # (api_url, poa) -> Web3
+_contract_info = {}  # resolved path -> (mtime, parsed json)
+_contracts = {}  # (id of the shared Web3, address, ABI entry names) -> contract
+
+
+def get_session():
+    """
+        Returns the process-wide requests.Session used by every HTTP provider,
+        so connections (and TLS handshakes) are reused between calls
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def get_web3(api_url, poa=True):
+    """
+        Returns the shared Web3 instance for api_url, creating it on first use
+        poa - inject the POA compatibility middleware (needed for avax and bsc)
+    """
+    key = (api_url, poa)
+    if key not in _web3:
+        w3 = Web3(Web3.HTTPProvider(api_url, session=get_session()))
+        if poa:
+            # inject the poa compatibility middleware to the innermost layer
+            w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+        _web3[key] = w3
+    return _web3[key]
+
+
+def load_contract_info(contract_info):
+    """
+        Returns the parsed contents of a contract_info json file
+        The file is only read again if it has changed on disk
+    """
+    path = Path(contract_info).resolve()
+    mtime = path.stat().st_mtime
+    cached = _contract_info.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as f:
+            cached = (mtime, json.load(f))
+        _contract_info[path] = cached
+    return cached[1]
+
+
+def get_contract(w3, address, abi):
+    """
+        Returns the shared contract object for address on the chain w3 is connected to
+        w3 should come from get_web3
+    """
+    address = Web3.to_checksum_address(address)
+    # The same address can be used with different (partial) ABIs, e.g. only the Deposit event
+    key = (id(w3), address, tuple((item.get('type'), item.get('name')) for item in abi))
+    if key not in _contracts:
+        _contracts[key] = w3.eth.contract(address=address, abi=abi)
+    return _contracts[key]
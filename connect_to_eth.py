@@ -1,7 +1,4 @@
-import json
-from web3 import Web3
-from web3.middleware import ExtraDataToPOAMiddleware
-from web3.providers.rpc import HTTPProvider
+import clients
 
 '''
 If you use one of the suggested infrastructure providers, the url will be of the form
@@ -12,29 +9,26 @@ infura_url = f"https://mainnet.infura.io/v3/{infura_token}"
 
 def connect_to_eth():
 	url = "https://eth-mainnet.g.alchemy.com/v2/LHVOmQ8jxx3C6cqURK1J3"  # FILL THIS IN
-	w3 = Web3(HTTPProvider(url))
+	w3 = clients.get_web3(url, poa=False)
 	assert w3.is_connected(), f"Failed to connect to provider at {url}"
 	return w3
 
 
 def connect_with_middleware(contract_json):
-	with open(contract_json, "r") as f:
-		d = json.load(f)
-		d = d['bsc']
-		address = d['address']
-		abi = d['abi']
+	d = clients.load_contract_info(contract_json)['bsc']
+	address = d['address']
+	abi = d['abi']
 
 	# TODO complete this method
 	# The first section will be the same as "connect_to_eth()" but with a BNB url
 	url = "https://bnb-testnet.g.alchemy.com/v2/LHVOmQ8jxx3C6cqURK1J3"
-	w3 = Web3(HTTPProvider(url))
+	w3 = clients.get_web3(url)
 	assert w3.is_connected(), f"Failed to connect to provider at {url}"
 
 	# The second section requires you to inject middleware into your w3 object and
 	# create a contract object. Read more on the docs pages at https://web3py.readthedocs.io/en/stable/middleware.html
 	# and https://web3py.readthedocs.io/en/stable/web3.contract.html
-	w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
-	contract = w3.eth.contract(address=address, abi=abi)
+	contract = clients.get_contract(w3, address, abi)
 
 	return w3, contract
 
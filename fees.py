@@ -0,0 +1,72 @@
+import time
+
+
+FEE_TTL = 2  # Seconds fee data is reused for without checking for a new block (about one block on avax and bsc)
+FEE_HISTORY_BLOCKS = 5  # Blocks of history used to pick the priority fee
+PRIORITY_PERCENTILE = 50
+MIN_PRIORITY_FEE = 1000000000  # 1 gwei
+GAS_MARGIN = 1.5  # Multiplier on cached gas estimates, since the cost of a call depends on its arguments
+
+_fees = {}  # id of the Web3 instance -> (block number, time checked, fee parameters)
+_gas_estimates = {}  # (id of the Web3 instance, contract address, function, token) -> gas limit
+
+
+def get_fee_params(w3):
+    """
+        Returns the fee fields to put in a transaction on the chain w3 is connected to
+        For EIP-1559 chains this is maxFeePerGas/maxPriorityFeePerGas built from eth_feeHistory,
+        otherwise gasPrice
+        Fee data is fetched once per new block, so every transaction sent before the next block shares one lookup.
+        Within FEE_TTL seconds of the last check the cached fees are reused without even asking for the block number
+    """
+    key = id(w3)
+    cached = _fees.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached[1] < FEE_TTL:
+        return cached[2]
+
+    block_num = w3.eth.block_number
+    if cached is not None and cached[0] == block_num:
+        _fees[key] = (block_num, now, cached[2])
+        return cached[2]
+
+    try:
+        history = w3.eth.fee_history(FEE_HISTORY_BLOCKS, block_num, [PRIORITY_PERCENTILE])
+        # The last entry is the base fee of the next block
+        base_fee = history['baseFeePerGas'][-1]
+        rewards = sorted(r[0] for r in history['reward'])
+        priority_fee = max(MIN_PRIORITY_FEE, rewards[len(rewards) // 2]) if rewards else MIN_PRIORITY_FEE
+        params = {
+            'maxFeePerGas': 2 * base_fee + priority_fee,
+            'maxPriorityFeePerGas': priority_fee,
+        }
+    except Exception as e:
+        # Chain (or provider) without eth_feeHistory, use a legacy transaction
+        print(f"eth_feeHistory unavailable, using gasPrice: {e}")
+        params = {'gasPrice': w3.eth.gas_price}
+
+    _fees[key] = (block_num, now, params)
+    return params
+
+
+DEFAULT_GAS = 300000  # Gas limit used when a call cannot be estimated
+
+
+def estimate_gas(w3, call, sender, default=DEFAULT_GAS):
+    """
+        Returns a gas limit for the contract function call, sent from sender
+        Estimates are cached per (contract, function, token), where token is the first argument of the call,
+        and padded by GAS_MARGIN
+        If the estimate fails, default is returned (and not cached)
+    """
+    token = call.args[0] if len(call.args) > 0 else None
+    if isinstance(token, list):
+        token = tuple(token)
+    key = (id(w3), call.address, call.fn_name, token)
+    if key not in _gas_estimates:
+        try:
+            _gas_estimates[key] = int(call.estimate_gas({'from': sender}) * GAS_MARGIN)
+        except Exception as e:
+            print(f"Could not estimate gas for {call.fn_name}: {e}")
+            return default
+    return _gas_estimates[key]
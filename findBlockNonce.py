@@ -1,10 +1,20 @@
 #!/bin/python
 import hashlib
+import multiprocessing
 import os
+import queue
 import random
+import time
+import numpy as np
 
 
-def mine_block(k, prev_hash, transactions):
+MINE_BATCH_SIZE = 4096  # Nonces tried between progress/stop checks while mining
+WORKER_CHECK_INTERVAL = 1  # Seconds between checks that the mining workers are still alive
+LINE_INDEX_SUFFIX = ".idx"  # get_random_lines keeps the line index of a file next to it under this suffix
+LINE_INDEX_CHUNK = 1 << 24  # Bytes read at a time while building a line index
+
+
+def mine_block(k, prev_hash, transactions, processes=1, report=False):
     """
         k - Number of trailing zeros in the binary representation (integer)
         prev_hash - the hash of the previous block (bytes)
@@ -13,57 +23,218 @@ def mine_block(k, prev_hash, transactions):
         Complete this function to find a nonce such that 
         sha256( prev_hash + rand_lines + nonce )
         has k trailing zeros in its *binary* representation
+
+        processes - number of worker processes to search with (None for one per core, see mine_block_parallel)
+        report - print the hash rate once a nonce is found
     """
     if not isinstance(k, int) or k < 0:
         print("mine_block expects positive integer")
         return b'\x00'
+    if processes != 1:
+        return mine_block_parallel(k, prev_hash, transactions, processes, report)
 
-    transaction_bytes = ''.join(transactions).encode('utf-8')
-    
-    nonce = 0
+    prefix = prefix_hash(prev_hash, transactions)
+    started = time.time()
+    start = 0
     while True:
-        nonce_bytes = str(nonce).encode('utf-8')
-        
-        combined = prev_hash + transaction_bytes + nonce_bytes
-        
-        block_hash = hashlib.sha256(combined).digest()
-        
-        hash_int = int.from_bytes(block_hash, byteorder='big')
-        
-        trailing_zeros = 0
-        temp = hash_int
-        while temp & 1 == 0 and trailing_zeros < k + 1:
-            trailing_zeros += 1
-            temp >>= 1
-        
-        if trailing_zeros >= k:
-            nonce_str = str(nonce)
-            nonce = nonce_str.encode('utf-8')
+        nonce = search_nonces(k, prefix, start, MINE_BATCH_SIZE)
+        if nonce is not None:
             break
-        
-        nonce += 1
+        start += MINE_BATCH_SIZE
+
+    if report:
+        print_hash_rate(int(nonce) + 1, time.time() - started)
+    assert isinstance(nonce, bytes), 'nonce should be of type bytes'
+    return nonce
+
+
+def prefix_hash(prev_hash, transactions):
+    """
+        Returns a sha256 object that has already hashed prev_hash and the transactions
+        Every nonce shares this prefix, so each one only has to copy() it and hash the nonce itself
+    """
+    prefix = hashlib.sha256(prev_hash)
+    prefix.update(''.join(transactions).encode('utf-8'))
+    return prefix
+
+
+def search_nonces(k, prefix, start, count, step=1):
+    """
+        Tries count nonces start, start + step, ... against prefix (from prefix_hash)
+        Returns the first one whose hash has k trailing zeros (as bytes), or None
+    """
+    # k trailing zeros only involve the last ceil(k / 8) bytes of the digest
+    tail = max(0, 32 - (k + 7) // 8)
+    mask = (1 << k) - 1
+    for nonce in range(start, start + count * step, step):
+        nonce_bytes = str(nonce).encode('utf-8')
+        h = prefix.copy()
+        h.update(nonce_bytes)
+        if int.from_bytes(h.digest()[tail:], byteorder='big') & mask == 0:
+            return nonce_bytes
+    return None
+
+
+def print_hash_rate(hashes, elapsed):
+    rate = hashes / elapsed if elapsed > 0 else 0
+    print(f"Tried {hashes} nonces in {elapsed:.2f}s ({rate:,.0f} hashes/sec)")
+
+
+def mine_block_parallel(k, prev_hash, transactions, processes=None, report=False):
+    """
+        Same as mine_block, but the nonce space is split between processes worker processes
+        (worker w tries nonces w, w + processes, w + 2 * processes, ...)
+        All workers stop as soon as one of them finds a valid nonce
+        Returns the nonce as bytes, in the same format as mine_block
+    """
+    if not isinstance(k, int) or k < 0:
+        print("mine_block expects positive integer")
+        return b'\x00'
 
+    processes = processes or os.cpu_count() or 1
+    prefix = prev_hash + ''.join(transactions).encode('utf-8')
+
+    ctx = multiprocessing.get_context()
+    stop = ctx.Event()
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=_mine_worker, args=(k, prefix, w, processes, stop, results), daemon=True)
+        for w in range(processes)
+    ]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    try:
+        nonce = _wait_for_nonce(workers, results)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+    if report:
+        # The workers move in step, so every nonce below the one found has (roughly) been tried
+        print_hash_rate(int(nonce) + 1, time.time() - started)
     assert isinstance(nonce, bytes), 'nonce should be of type bytes'
     return nonce
 
 
-def get_random_lines(filename, quantity):
+def _wait_for_nonce(workers, results):
+    """
+        Returns the first nonce a worker posts to results
+        Raises RuntimeError if every worker has exited (e.g. crashed or was killed) without posting one
+    """
+    while True:
+        try:
+            return results.get(timeout=WORKER_CHECK_INTERVAL)
+        except queue.Empty:
+            pass
+        if not any(worker.is_alive() for worker in workers):
+            # A worker may have posted its nonce just before exiting
+            try:
+                return results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                exit_codes = [worker.exitcode for worker in workers]
+                raise RuntimeError(f"Every mining worker exited without finding a nonce (exit codes {exit_codes})")
+
+
+def _mine_worker(k, prefix, start, step, stop, results):
+    """
+        Tries nonces start, start + step, ... until one gives k trailing zeros or stop is set
+        Checks for a stop request after every MINE_BATCH_SIZE nonces, the Event is slow to read
+    """
+    # hashlib objects can't be pickled, so each worker hashes the prefix itself
+    prefix = hashlib.sha256(prefix)
+    while not stop.is_set():
+        nonce = search_nonces(k, prefix, start, MINE_BATCH_SIZE, step)
+        if nonce is not None:
+            results.put(nonce)
+            stop.set()
+            return
+        start += MINE_BATCH_SIZE * step
+
+
+def get_random_lines(filename, quantity, method='index'):
     """
     This is a helper function to get the quantity of lines ("transactions")
-    as a list from the filename given. 
-    Do not modify this function
+    as a list from the filename given.
+    method - 'index' picks quantity random lines (with replacement) through the line index
+             of filename (see build_line_index), one seek per line
+             'stream' reservoir-samples quantity distinct lines in one pass with constant memory,
+             for files that have no index
     """
-    lines = []
-    with open(filename, 'r') as f:
-        for line in f:
-            lines.append(line.strip())
+    if method == 'stream':
+        return sample_lines(filename, quantity)
 
+    offsets = open_line_index(filename)
+    num_lines = len(offsets) - 1
+    if num_lines == 0:
+        return []
     random_lines = []
-    for x in range(quantity):
-        random_lines.append(lines[random.randint(0, quantity - 1)])
+    with open(filename, 'rb') as f:
+        for x in range(quantity):
+            i = random.randrange(num_lines)
+            f.seek(int(offsets[i]))
+            random_lines.append(f.read(int(offsets[i + 1] - offsets[i])).decode('utf-8').strip())
     return random_lines
 
 
+def build_line_index(filename, index_file=None):
+    """
+        Writes the byte offset of the start of every line of filename to index_file
+        (default filename + LINE_INDEX_SUFFIX) as raw uint64s, followed by the size of the file,
+        so line i is bytes offsets[i]:offsets[i + 1]
+        The file is read in LINE_INDEX_CHUNK sized pieces, so it never has to fit in memory
+    """
+    index_file = index_file or filename + LINE_INDEX_SUFFIX
+    tmp_file = f"{index_file}.tmp"
+    size = 0
+    last_byte = b'\n'
+    with open(filename, 'rb') as f, open(tmp_file, 'wb') as out:
+        out.write(np.array([0], dtype=np.uint64).tobytes())
+        while True:
+            chunk = f.read(LINE_INDEX_CHUNK)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            out.write((newlines + size + 1).astype(np.uint64).tobytes())
+            size += len(chunk)
+            last_byte = chunk[-1:]
+        if last_byte != b'\n':
+            # The last line has no newline, close it off at the end of the file
+            out.write(np.array([size], dtype=np.uint64).tobytes())
+    os.replace(tmp_file, index_file)
+    return index_file
+
+
+def open_line_index(filename, index_file=None):
+    """
+        Returns the line offsets of filename as a read-only memory-mapped numpy array,
+        building the index first if it doesn't exist or is older than filename
+    """
+    index_file = index_file or filename + LINE_INDEX_SUFFIX
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(filename):
+        build_line_index(filename, index_file)
+    return np.memmap(index_file, dtype=np.uint64, mode='r')
+
+
+def sample_lines(filename, quantity):
+    """
+        Reservoir sampling (Algorithm R): returns quantity distinct random lines of filename
+        (or all of them if it has fewer) reading the file once and keeping only quantity lines in memory
+    """
+    sample = []
+    with open(filename, 'r') as f:
+        for i, line in enumerate(f):
+            if i < quantity:
+                sample.append(line.strip())
+            else:
+                j = random.randint(0, i)
+                if j < quantity:
+                    sample[j] = line.strip()
+    random.shuffle(sample)
+    return sample
+
+
 if __name__ == '__main__':
     filename = "bitcoin_text.txt"
     num_lines = 10
@@ -72,5 +243,5 @@ if __name__ == '__main__':
 
     prev_hash = b'previous_block_hash'
     transactions = get_random_lines(filename, num_lines)
-    nonce = mine_block(diff, prev_hash, transactions)
+    nonce = mine_block(diff, prev_hash, transactions, processes=None, report=True)
     print(nonce)
@@ -1,40 +1,125 @@
 from web3 import Web3
-from web3.providers.rpc import HTTPProvider
-from web3.middleware import ExtraDataToPOAMiddleware #Necessary for POA chains
 from pathlib import Path
 import json
 from datetime import datetime
 import pandas as pd
+import csv
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import clients
+import logfetch
+import metrics
 
 
-def scan_blocks(chain, start_block, end_block, contract_address, eventfile='deposit_logs.csv'):
+API_URLS = {
+    'avax': "https://api.avax-test.network/ext/bc/C/rpc",  # AVAX C-chain testnet
+    'bsc': "https://data-seed-prebsc-1-s1.binance.org:8545/",  # BSC testnet
+}
+DEPOSIT_ABI = json.loads('[ { "anonymous": false, "inputs": [ { "indexed": true, "internalType": "address", "name": "token", "type": "address" }, { "indexed": true, "internalType": "address", "name": "recipient", "type": "address" }, { "indexed": false, "internalType": "uint256", "name": "amount", "type": "uint256" } ], "name": "Deposit", "type": "event" }]')
+EVENT_COLUMNS = ['chain', 'token', 'recipient', 'amount', 'transactionHash', 'address', 'blockNumber', 'logIndex']
+BLOCK_BATCH_SIZE = 100  # Blocks per JSON-RPC batch when looking up event timestamps
+
+
+def connect_to(chain):
+    """
+        Returns the shared web3 instance for chain ('avax' or 'bsc')
+    """
+    # Shared instance with a pooled HTTP session and the poa middleware already injected
+    return clients.get_web3(API_URLS[chain])
+
+
+def event_db_path(eventfile):
+    """
+        Returns the SQLite file that indexes the events written to eventfile (e.g. deposit_logs.db)
+    """
+    return str(Path(eventfile).with_suffix('.db'))
+
+
+def open_event_db(path):
+    """
+        Opens (and creates if needed) the SQLite file of stored events, keyed on (transactionHash, logIndex)
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS events ("
+                 "chain TEXT, token TEXT, recipient TEXT, amount TEXT, transactionHash TEXT NOT NULL, "
+                 "address TEXT, blockNumber INTEGER, logIndex INTEGER NOT NULL, "
+                 "PRIMARY KEY (transactionHash, logIndex))")
+    conn.commit()
+    return conn
+
+
+def store_events(conn, event_data):
+    """
+        Inserts the events in event_data (list of dictionaries with the EVENT_COLUMNS keys)
+        Events that are already stored are skipped
+        Does not commit, see save_events
+        Returns the list of events that were new
+    """
+    new_rows = []
+    for data in event_data:
+        cur = conn.execute(
+            f"INSERT OR IGNORE INTO events ({', '.join(EVENT_COLUMNS)}) VALUES ({', '.join('?' * len(EVENT_COLUMNS))})",
+            # amount is stored as text since uint256 values do not fit in a SQLite integer
+            [str(data[c]) if c == 'amount' else data[c] for c in EVENT_COLUMNS]
+        )
+        if cur.rowcount == 1:
+            new_rows.append(data)
+    return new_rows
+
+
+def append_events(eventfile, rows):
+    """
+        Appends rows to the csv eventfile, writing the header if the file is new
+        A file written by an older version (without blockNumber/logIndex) is rewritten once with the new columns
+    """
+    path = Path(eventfile)
+    if path.exists():
+        with open(path, 'r', newline='') as f:
+            header = next(csv.reader(f), None)
+        if header is not None and header != EVENT_COLUMNS:
+            existing_df = pd.read_csv(path)
+            existing_df.reindex(columns=EVENT_COLUMNS).to_csv(path, index=False)
+    write_header = not path.exists() or path.stat().st_size == 0
+    if len(rows) == 0 and not write_header:
+        return
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=EVENT_COLUMNS)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def save_events(eventfile, event_data):
+    """
+        Appends the events in event_data that were not stored before to the csv eventfile, and indexes them
+        The index only commits once the append succeeded, so events are never marked stored without being in
+        the csv (a crash between the two can at worst append an event twice on the next run)
+    """
+    conn = open_event_db(event_db_path(eventfile))
+    try:
+        with conn:
+            new_rows = store_events(conn, event_data)
+            append_events(eventfile, new_rows)
+    finally:
+        conn.close()
+
+
+def scan_blocks(chain, start_block, end_block, contract_address, eventfile='deposit_logs.csv', workers=1, max_rps=None,
+                metrics_file=None):
     """
     chain - string (Either 'bsc' or 'avax')
     start_block - integer first block to scan
     end_block - integer last block to scan
     contract_address - the address of the deployed contract
+    workers - number of parallel eth_getLogs workers to use for long backfills (default 1, serial)
+    max_rps - (optional) maximum requests per second to send to the provider
+    metrics_file - (optional) file to write Prometheus metrics to after the scan
 
 	This function reads "Deposit" events from the specified contract, 
 	and writes information about the events to the file "deposit_logs.csv"
     """
-    if chain == 'avax':
-        api_url = f"https://api.avax-test.network/ext/bc/C/rpc" #AVAX C-chain testnet
-
-    if chain == 'bsc':
-        api_url = f"https://data-seed-prebsc-1-s1.binance.org:8545/" #BSC testnet
-
-    if chain in ['avax','bsc']:
-        w3 = Web3(Web3.HTTPProvider(api_url))
-        # inject the poa compatibility middleware to the innermost layer
-        w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
-    else:
-        w3 = Web3(Web3.HTTPProvider(api_url))
-
-    contract_address = Web3.to_checksum_address(contract_address)
-    DEPOSIT_ABI = json.loads('[ { "anonymous": false, "inputs": [ { "indexed": true, "internalType": "address", "name": "token", "type": "address" }, { "indexed": true, "internalType": "address", "name": "recipient", "type": "address" }, { "indexed": false, "internalType": "uint256", "name": "amount", "type": "uint256" } ], "name": "Deposit", "type": "event" }]')
-    contract = w3.eth.contract(address=contract_address, abi=DEPOSIT_ABI)
-
-    arg_filter = {}
+    w3 = connect_to(chain)
+    contract = clients.get_contract(w3, contract_address, DEPOSIT_ABI)
 
     if start_block == "latest":
         start_block = w3.eth.get_block_number()
@@ -51,17 +136,16 @@ def scan_blocks(chain, start_block, end_block, contract_address, eventfile='depo
     else:
         print( f"Scanning blocks {start_block} - {end_block} on {chain}" )
 
-    all_events = []
-    
-    if end_block - start_block < 30:
-        event_filter = contract.events.Deposit.create_filter(from_block=start_block,to_block=end_block,argument_filters=arg_filter)
-        events = event_filter.get_all_entries()
-        all_events.extend(events)
-    else:
-        for block_num in range(start_block,end_block+1):
-            event_filter = contract.events.Deposit.create_filter(from_block=block_num,to_block=block_num,argument_filters=arg_filter)
-            events = event_filter.get_all_entries()
-            all_events.extend(events)
+    # eth_getLogs splits the range by itself when the provider limits it, so no per-block fallback is needed
+    try:
+        all_events = logfetch.get_events(contract, 'Deposit', start_block, end_block, workers=workers, max_rps=max_rps)
+    except Exception:
+        metrics.inc('listener_rpc_errors_total', chain=chain)
+        raise
+    metrics.inc('listener_blocks_scanned_total', end_block - start_block + 1, chain=chain)
+    metrics.inc('listener_events_total', len(all_events), chain=chain)
+    if metrics_file is not None:
+        metrics.write(metrics_file)
     
     if len(all_events) > 0:
         event_data = []
@@ -72,14 +156,169 @@ def scan_blocks(chain, start_block, end_block, contract_address, eventfile='depo
                 'recipient': str(evt.args['recipient']),
                 'amount': int(evt.args['amount']),
                 'transactionHash': evt.transactionHash.hex(),
-                'address': str(evt.address)
+                'address': str(evt.address),
+                'blockNumber': int(evt.blockNumber),
+                'logIndex': int(evt.logIndex),
             }
             event_data.append(data)
-        
-        df = pd.DataFrame(event_data)
-        
-        if Path(eventfile).exists():
-            existing_df = pd.read_csv(eventfile)
-            df = pd.concat([existing_df, df], ignore_index=True)
-        
-        df.to_csv(eventfile, index=False)
+
+        # Only events we have not stored before are appended, so the cost depends on the new events only
+        save_events(eventfile, event_data)
+
+
+def load_watch_list(watchfile):
+    """
+        Reads the list of (chain, contract, event ABI) entries to watch
+        watchfile can be
+          a json file with a list of {"chain": ..., "address": ..., "abi": [...]} entries ("abi" defaults to the Deposit event)
+          a csv file with chain,address columns (like erc20s.csv), watched for Deposit events
+        Returns a list of dictionaries with chain, address and abi keys
+    """
+    if str(watchfile).endswith('.csv'):
+        with open(watchfile, 'r', newline='') as f:
+            return [{'chain': row['chain'], 'address': row['address'], 'abi': DEPOSIT_ABI} for row in csv.DictReader(f)]
+    with open(watchfile, 'r') as f:
+        entries = json.load(f)
+    return [{'chain': e['chain'], 'address': e['address'], 'abi': e.get('abi', DEPOSIT_ABI)} for e in entries]
+
+
+def get_block_timestamps(w3, block_nums, batch_size=BLOCK_BATCH_SIZE):
+    """
+        Returns a dictionary mapping each block number in block_nums to its timestamp
+        Blocks (without their transactions) are fetched in JSON-RPC batches of batch_size, or one request
+        per block if the provider rejects batches
+    """
+    block_nums = sorted(set(block_nums))
+    timestamps = {}
+    for i in range(0, len(block_nums), batch_size):
+        chunk = block_nums[i:i + batch_size]
+        try:
+            with w3.batch_requests() as batch:
+                for block_num in chunk:
+                    batch.add(w3.eth.get_block(block_num))
+                blocks = batch.execute()
+        except Exception as e:
+            print(f"Batch request for blocks {chunk[0]} - {chunk[-1]} failed ({e}), fetching them one at a time")
+            blocks = [w3.eth.get_block(block_num) for block_num in chunk]
+        for block_num, block in zip(chunk, blocks):
+            timestamps[block_num] = int(block['timestamp'])
+    return timestamps
+
+
+def scan_chain(chain, entries, start_block, end_block, workers=1, max_rps=None):
+    """
+        Scans every entry of the watch list on chain with shared eth_getLogs calls
+        (one request per block range covering all the addresses and event topics)
+        Returns a list of event dictionaries with chain, address, event, args, blockNumber, logIndex,
+        transactionHash and timestamp keys
+    """
+    w3 = connect_to(chain)
+    if start_block == "latest" or end_block == "latest":
+        latest = w3.eth.get_block_number()
+        start_block = latest if start_block == "latest" else start_block
+        end_block = latest if end_block == "latest" else end_block
+
+    # Entries for the same contract are merged so it is decoded with all of its watched events
+    abis = {}
+    for entry in entries:
+        address = Web3.to_checksum_address(entry['address'])
+        abis.setdefault(address, [])
+        abis[address] += [e for e in entry['abi'] if e.get('type') == 'event' and e not in abis[address]]
+
+    contracts = {}
+    watched = {}  # address -> topics watched on that address
+    topics = {}
+    for address, abi in abis.items():
+        contracts[address] = clients.get_contract(w3, address, abi)
+        contract_topics = logfetch.event_topics(contracts[address], [e['name'] for e in abi])
+        watched[address] = set(contract_topics)
+        topics.update(contract_topics)
+
+    print( f"Scanning blocks {start_block} - {end_block} on {chain} for {len(contracts)} contracts" )
+    try:
+        if workers > 1:
+            logs = logfetch.get_logs_parallel(w3, list(contracts), topics, start_block, end_block, workers=workers, max_rps=max_rps)
+        else:
+            logs = logfetch.get_logs(w3, list(contracts), topics, start_block, end_block,
+                                     logfetch.RateLimiter(max_rps) if max_rps else None)
+    except Exception:
+        metrics.inc('listener_rpc_errors_total', chain=chain)
+        raise
+    metrics.inc('listener_blocks_scanned_total', end_block - start_block + 1, chain=chain)
+
+    decoded = []
+    for log in logs:
+        address = Web3.to_checksum_address(log['address'])
+        topic = Web3.to_hex(log['topics'][0])
+        if topic not in watched[address]:
+            # The topic belongs to an event watched on another contract of this chain
+            continue
+        contract = contracts[address]
+        event_abi = topics[topic]
+        decoded.append(getattr(contract.events, event_abi['name'])().process_log(log))
+
+    # One batched lookup for every block that has an event, instead of a request per block
+    try:
+        timestamps = get_block_timestamps(w3, [evt.blockNumber for evt in decoded])
+    except Exception:
+        metrics.inc('listener_rpc_errors_total', chain=chain)
+        raise
+    events = []
+    for evt in decoded:
+        events.append({
+            'chain': chain,
+            'address': str(evt.address),
+            'event': evt.event,
+            'args': dict(evt.args),
+            'blockNumber': int(evt.blockNumber),
+            'logIndex': int(evt.logIndex),
+            'transactionHash': evt.transactionHash.hex(),
+            'timestamp': int(timestamps[evt.blockNumber]),
+        })
+    metrics.inc('listener_events_total', len(events), chain=chain)
+    return events
+
+
+def scan_watch_list(watchfile, start_block, end_block, eventfile=None, workers=1, max_rps=None):
+    """
+        watchfile - watch list file (see load_watch_list)
+        start_block, end_block - block numbers (or "latest"), either one value for every chain
+        or a dictionary with one value per chain
+        Scans all chains in the watch list concurrently and returns their events merged into one
+        list ordered by block timestamp (then chain, block and log index)
+        If eventfile is given, Deposit events are also stored there the same way scan_blocks does
+    """
+    by_chain = {}
+    for entry in load_watch_list(watchfile):
+        by_chain.setdefault(entry['chain'], []).append(entry)
+
+    def per_chain(value, chain):
+        return value[chain] if isinstance(value, dict) else value
+
+    with ThreadPoolExecutor(max_workers=len(by_chain) or 1) as executor:
+        futures = [
+            executor.submit(scan_chain, chain, entries, per_chain(start_block, chain), per_chain(end_block, chain), workers, max_rps)
+            for chain, entries in by_chain.items()
+        ]
+        events = [evt for future in futures for evt in future.result()]
+
+    events.sort(key=lambda e: (e['timestamp'], e['chain'], e['blockNumber'], e['logIndex']))
+
+    if eventfile is not None:
+        event_data = []
+        for evt in events:
+            if evt['event'] != 'Deposit':
+                continue
+            event_data.append({
+                'chain': evt['chain'],
+                'token': str(evt['args']['token']),
+                'recipient': str(evt['args']['recipient']),
+                'amount': int(evt['args']['amount']),
+                'transactionHash': evt['transactionHash'],
+                'address': evt['address'],
+                'blockNumber': evt['blockNumber'],
+                'logIndex': evt['logIndex'],
+            })
+        save_events(eventfile, event_data)
+
+    return events
@@ -0,0 +1,182 @@
+from web3 import Web3
+from eth_utils import event_abi_to_log_topic
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+INITIAL_RANGE = 500  # Blocks per eth_getLogs request before we learn what the provider accepts
+MAX_RANGE = 10000  # Never ask for more blocks than this in one request
+SPARSE_LOGS = 100  # Grow the range after a request that returned fewer logs than this
+BACKFILL_CHUNK = 2000  # Blocks handed to each worker in a parallel backfill
+BACKFILL_WORKERS = 8
+
+# Errors that providers return when a request covers more blocks than they allow, whatever it matches
+BLOCK_RANGE_ERRORS = [
+    "block range",  # bsc: "exceed maximum block range: 5000"
+    "too many blocks",  # avax: "requested too many blocks from X to Y, maximum is set to 2048"
+    "range too large",
+]
+# Errors that providers return when a request matches too many logs (or takes too long)
+RANGE_ERRORS = BLOCK_RANGE_ERRORS + [
+    "response size",  # alchemy: "Log response size exceeded"
+    "more than 10000 results",  # infura
+    "query timeout",
+]
+
+# Last range size that worked (unclipped) for each RPC endpoint, so later calls start from it
+_range_sizes = {}
+# Smallest range size each RPC endpoint has rejected as too many blocks, ranges are never grown to it again
+_range_limits = {}
+
+
+class RateLimiter:
+    """
+        Spaces out calls to wait() so that at most max_rps of them return per second, across all threads
+    """
+    def __init__(self, max_rps):
+        self.interval = 1.0 / max_rps
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def event_topics(contract, event_names):
+    """
+        Returns a dictionary mapping the topic0 hash (hex) of each event in event_names to its ABI
+    """
+    topics = {}
+    for item in contract.abi:
+        if item.get('type') == 'event' and item['name'] in event_names:
+            topics[Web3.to_hex(event_abi_to_log_topic(item))] = item
+    return topics
+
+
+def is_range_error(e):
+    """
+        Returns True if e looks like the provider rejecting a range that is too large
+    """
+    message = str(e).lower()
+    return any(text in message for text in RANGE_ERRORS)
+
+
+def is_block_range_error(e):
+    """
+        Returns True if e is the provider rejecting the number of blocks in a request (not the number of logs)
+    """
+    message = str(e).lower()
+    return any(text in message for text in BLOCK_RANGE_ERRORS)
+
+
+def next_range_size(endpoint, size):
+    """
+        Returns the range size to try after a sparse request of size blocks succeeded on endpoint
+        Doubles it (up to MAX_RANGE), but stays below the smallest size the endpoint rejected, bisecting
+        towards that limit only while the gap is more than half the current size
+    """
+    grown = min(MAX_RANGE, size * 2)
+    limit = _range_limits.get(endpoint)
+    if limit is None or grown < limit:
+        return grown
+    if limit - size > size // 2:
+        return (size + limit) // 2
+    return size
+
+
+def get_logs(w3, addresses, topics, start_block, end_block, rate_limiter=None):
+    """
+        w3 - web3 instance
+        addresses - list of contract addresses to match
+        topics - list of topic0 hashes to match (any of them)
+        rate_limiter - (optional) RateLimiter every request waits on
+        Fetches the raw logs between start_block and end_block (inclusive) with plain eth_getLogs calls
+        The range per request is halved when the provider says it is too large, and doubled (up to MAX_RANGE,
+        and below any block limit the provider has shown, see next_range_size) when a request comes back sparse
+        Returns the list of logs in block order
+    """
+    endpoint = getattr(w3.provider, 'endpoint_uri', None)
+    size = _range_sizes.get(endpoint, INITIAL_RANGE)
+    params = {
+        'address': [Web3.to_checksum_address(a) for a in addresses],
+        'topics': [list(topics)],
+    }
+
+    all_logs = []
+    current = start_block
+    while current <= end_block:
+        to_block = min(end_block, current + size - 1)
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            logs = w3.eth.get_logs({**params, 'fromBlock': current, 'toBlock': to_block})
+        except Exception as e:
+            if is_range_error(e) and size > 1:
+                known_good = _range_sizes.get(endpoint, 0)
+                if is_block_range_error(e):
+                    _range_limits[endpoint] = min(size, _range_limits.get(endpoint, size))
+                    # Go straight back to the last size that worked instead of halving below it
+                    size = known_good if 0 < known_good < size else max(1, size // 2)
+                else:
+                    size = max(1, size // 2)
+                continue
+            raise
+        all_logs.extend(logs)
+        if to_block - current + 1 == size:
+            # A clipped request at the end of the range says nothing about size itself
+            _range_sizes[endpoint] = size
+            if len(logs) < SPARSE_LOGS:
+                size = next_range_size(endpoint, size)
+        current = to_block + 1
+    return all_logs
+
+
+def get_logs_parallel(w3, addresses, topics, start_block, end_block, chunk_size=BACKFILL_CHUNK,
+                      workers=BACKFILL_WORKERS, max_rps=None):
+    """
+        Same as get_logs, but splits the range into chunk_size pieces fetched by a pool of workers
+        max_rps - (optional) cap on eth_getLogs requests per second across all workers
+        Returns the logs in block order
+    """
+    rate_limiter = RateLimiter(max_rps) if max_rps else None
+    chunks = [(start, min(end_block, start + chunk_size - 1)) for start in range(start_block, end_block + 1, chunk_size)]
+    all_logs = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map returns results in chunk order, so the output stays ordered by block and log index
+        for logs in executor.map(lambda c: get_logs(w3, addresses, topics, c[0], c[1], rate_limiter), chunks):
+            all_logs.extend(logs)
+    return all_logs
+
+
+def decode_logs(contract, logs, topics):
+    """
+        Decodes raw logs into event data (with .args, .blockNumber, .logIndex, ...)
+        topics - the dictionary returned by event_topics
+    """
+    events = []
+    for log in logs:
+        event_abi = topics[Web3.to_hex(log['topics'][0])]
+        events.append(getattr(contract.events, event_abi['name'])().process_log(log))
+    return events
+
+
+def get_events(contract, event_name, start_block, end_block, workers=1, max_rps=None):
+    """
+        Returns the decoded event_name events emitted by contract between start_block and end_block (inclusive)
+        Unlike create_filter, this keeps no filter state on the node
+        workers - if more than 1, fetch the range in parallel chunks (see get_logs_parallel)
+    """
+    topics = event_topics(contract, [event_name])
+    if workers > 1:
+        logs = get_logs_parallel(contract.w3, [contract.address], topics, start_block, end_block,
+                                 workers=workers, max_rps=max_rps)
+    else:
+        logs = get_logs(contract.w3, [contract.address], topics, start_block, end_block,
+                        RateLimiter(max_rps) if max_rps else None)
+    return decode_logs(contract, logs, topics)
@@ -0,0 +1,91 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+
+# Help text and type for every metric we export, in Prometheus text format terms
+METRICS = {
+    'bridge_blocks_scanned_total': ('counter', "Blocks scanned for bridge events"),
+    'bridge_events_found_total': ('counter', "Deposit/Unwrap events found"),
+    'bridge_events_relayed_total': ('counter', "Events whose relay transaction was mined successfully"),
+    'bridge_relay_failures_total': ('counter', "Events whose relay transaction reverted or was given up on"),
+    'bridge_rpc_errors_total': ('counter', "RPC calls that raised an error"),
+    'bridge_last_scanned_block': ('gauge', "Last block scanned"),
+    'bridge_scan_lag_blocks': ('gauge', "Blocks between the chain tip and the last scanned block"),
+    'bridge_relay_lag_seconds': ('gauge', "Seconds between the last relayed event's block and its relay being mined"),
+    'bridge_relay_lag_blocks': ('gauge', "Blocks between the last relayed event and the chain tip when it was relayed"),
+    'listener_blocks_scanned_total': ('counter', "Blocks scanned by the listener"),
+    'listener_events_total': ('counter', "Events found by the listener"),
+    'listener_rpc_errors_total': ('counter', "Listener RPC calls that raised an error"),
+}
+
+_values = {}  # (name, sorted label items) -> value
+_lock = threading.Lock()
+
+
+def inc(name, value=1, **labels):
+    """
+        Adds value to the counter name (rates such as blocks/sec come from rate() on these counters)
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = value
+
+
+def render():
+    """
+        Returns every recorded metric in the Prometheus text exposition format
+    """
+    with _lock:
+        values = dict(_values)
+    lines = []
+    for name in sorted({name for name, _ in values}):
+        kind, help_text = METRICS.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name:
+                continue
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    """
+        Writes the metrics to path (e.g. for the node_exporter textfile collector)
+        The file is replaced atomically so a scrape never sees a half-written file
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host=''):
+    """
+        Serves the metrics over HTTP on port from a background thread
+        Returns the server (call shutdown() on it to stop)
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
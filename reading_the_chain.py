@@ -1,10 +1,22 @@
 import random
-import json
-from web3 import Web3
-from web3.middleware import ExtraDataToPOAMiddleware
-from web3.providers.rpc import HTTPProvider
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
+import sqlite3
+import clients
 
 
+RPC_BATCH_SIZE = 20  # Blocks per JSON-RPC batch request (full blocks are large, and providers cap batch sizes)
+RPC_WORKERS = 4  # Batch requests in flight at once
+BLOCK_CACHE_DB = "block_cache.db"
+FINALITY_DEPTH = 64  # Blocks below the tip treated as final on chains without the 'finalized' tag
+MAX_FEE = 2 ** 63 - 1  # Fees are stored as int64
+# The only transaction fields the ordering check needs, stored as one compact row per transaction
+FEE_DTYPE = np.dtype([('type', 'u1'), ('gasPrice', '<i8'), ('maxFeePerGas', '<i8'), ('maxPriorityFeePerGas', '<i8')])
+
+_finalized = {}  # id(w3) -> highest block number known to be finalized
+_chain_ids = {}  # id(w3) -> chain id
+
 # If you use one of the suggested infrastructure providers, the url will be of the form
 # now_url  = f"https://eth.nownodes.io/{now_token}"
 # alchemy_url = f"https://eth-mainnet.alchemyapi.io/v2/{alchemy_token}"
@@ -12,29 +24,26 @@ from web3.providers.rpc import HTTPProvider
 
 def connect_to_eth():
 	url = "https://eth-mainnet.g.alchemy.com/v2/LHVOmQ8jxx3C6cqURK1J3"
-	w3 = Web3(HTTPProvider(url))
+	w3 = clients.get_web3(url, poa=False)
 	assert w3.is_connected(), f"Failed to connect to provider at {url}"
 	return w3
 
 
 def connect_with_middleware(contract_json):
-	with open(contract_json, "r") as f:
-		d = json.load(f)
-		d = d['bsc']
-		address = d['address']
-		abi = d['abi']
+	d = clients.load_contract_info(contract_json)['bsc']
+	address = d['address']
+	abi = d['abi']
 
 	url = "https://bnb-testnet.g.alchemy.com/v2/LHVOmQ8jxx3C6cqURK1J3"
-	w3 = Web3(HTTPProvider(url))
+	w3 = clients.get_web3(url)
 	assert w3.is_connected(), f"Failed to connect to provider at {url}"
 
-	w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
-	contract = w3.eth.contract(address=address, abi=abi)
+	contract = clients.get_contract(w3, address, abi)
 
 	return w3, contract
 
 
-def is_ordered_block(w3, block_num):
+def is_ordered_block(w3, block_num, cache_db=None):
 	"""
 	Takes a block number
 	Returns a boolean that tells whether all the transactions in the block are ordered by priority fee
@@ -46,31 +55,226 @@ def is_ordered_block(w3, block_num):
 		*Type 2* The priority fee is min( tx.maxPriorityFeePerGas, tx.maxFeePerGas - block.baseFeePerGas )
 
 	Conveniently, most type 2 transactions set the gasPrice field to be min( tx.maxPriorityFeePerGas + block.baseFeePerGas, tx.maxFeePerGas )
+
+	cache_db - (optional) SQLite file finalized blocks' fee columns are cached in (see open_block_cache, e.g. BLOCK_CACHE_DB)
+	           by default the block is always fetched
 	"""
-	block = w3.eth.get_block(block_num, full_transactions=True)
-	ordered = False
+	if cache_db is None:
+		return is_ordered(w3.eth.get_block(block_num, full_transactions=True))
+
+	conn = open_block_cache(cache_db)
+	try:
+		cached = get_cached_fees(conn, get_chain_id(w3), [block_num])
+		if block_num in cached:
+			return is_ordered_fees(*cached[block_num])
+		block = w3.eth.get_block(block_num, full_transactions=True)
+		base_fee, fees = fee_columns(block)
+		cache_fees(conn, w3, block, base_fee, fees)
+		conn.commit()
+		return is_ordered_fees(base_fee, fees)
+	finally:
+		conn.close()
 
+
+def is_ordered(block):
+	"""
+	Same as is_ordered_block, for a block that has already been fetched with full transactions
+	"""
+	return is_ordered_fees(*fee_columns(block))
+
+
+def fee_columns(block):
+	"""
+	Takes a block fetched with full transactions
+	Returns (base_fee, fees) where fees is a numpy array with one FEE_DTYPE row per transaction
+	maxPriorityFeePerGas is -1 for transactions that don't have one (legacy and access list transactions)
+	Fees are clipped to MAX_FEE so they fit in an int64 (no real transaction pays 9 ether per gas)
+	"""
 	transactions = block.transactions
-	if len(transactions) == 0:
+	fees = np.zeros(len(transactions), dtype=FEE_DTYPE)
+	fees['type'] = [tx.get('type', 0) for tx in transactions]
+	fees['gasPrice'] = [min(tx.get('gasPrice', 0), MAX_FEE) for tx in transactions]
+	fees['maxFeePerGas'] = [min(tx.get('maxFeePerGas') or 0, MAX_FEE) for tx in transactions]
+	fees['maxPriorityFeePerGas'] = [
+		-1 if tx.get('maxPriorityFeePerGas') is None else min(tx['maxPriorityFeePerGas'], MAX_FEE) for tx in transactions
+	]
+	return min(block.get('baseFeePerGas') or 0, MAX_FEE), fees
+
+
+def is_ordered_fees(base_fee, fees):
+	"""
+	The ordering check of is_ordered_block, vectorized over the columns returned by fee_columns
+	"""
+	if len(fees) == 0:
 		return True
-	
-	base_fee = block.get('baseFeePerGas', 0)
-	
-	priority_fees = []
-	for tx in transactions:
-		if 'maxPriorityFeePerGas' in tx and tx['maxPriorityFeePerGas'] is not None:
-			max_priority_fee = tx['maxPriorityFeePerGas']
-			max_fee = tx.get('maxFeePerGas', 0)
-			priority_fee = min(max_priority_fee, max_fee - base_fee)
-		else:
-			gas_price = tx.get('gasPrice', 0)
-			priority_fee = gas_price - base_fee
-		
-		priority_fees.append(priority_fee)
-	
-	ordered = all(priority_fees[i] >= priority_fees[i+1] for i in range(len(priority_fees)-1))
+	priority_fees = np.where(
+		fees['maxPriorityFeePerGas'] >= 0,
+		np.minimum(fees['maxPriorityFeePerGas'], fees['maxFeePerGas'] - base_fee),
+		fees['gasPrice'] - base_fee
+	)
+	return bool(np.all(priority_fees[:-1] >= priority_fees[1:]))
+
+
+def open_block_cache(cache_db=BLOCK_CACHE_DB):
+	"""
+	Opens (and creates if needed) the SQLite file that caches the fee columns of finalized blocks
+	Finalized blocks never change, so cached rows are never updated or expired
+	Rows are keyed by (chain id, block number), so one file can hold several chains
+	"""
+	conn = sqlite3.connect(cache_db)
+	columns = [row[1] for row in conn.execute("PRAGMA table_info(block_fees)")]
+	if columns and 'chain_id' not in columns:
+		# Rows from before the chain id was stored can't be attributed to a chain, and are only a cache
+		conn.execute("DROP TABLE block_fees")
+	conn.execute("CREATE TABLE IF NOT EXISTS block_fees (chain_id INTEGER NOT NULL, number INTEGER NOT NULL, hash BLOB NOT NULL, "
+				 "base_fee INTEGER NOT NULL, fees BLOB NOT NULL, PRIMARY KEY (chain_id, number))")
+	conn.commit()
+	return conn
+
+
+def get_cached_fees(conn, chain_id, block_nums):
+	"""
+	Returns a dictionary mapping each cached block of chain_id in block_nums to (base_fee, fees) as returned by fee_columns
+	"""
+	block_nums = list(block_nums)
+	cached = {}
+	# Stay under SQLite's limit on the number of query parameters
+	for i in range(0, len(block_nums), 500):
+		chunk = block_nums[i:i + 500]
+		rows = conn.execute(f"SELECT number, base_fee, fees FROM block_fees WHERE chain_id = ? AND number IN ({','.join('?' * len(chunk))})",
+							[chain_id] + chunk)
+		for number, base_fee, fees in rows:
+			cached[number] = (base_fee, np.frombuffer(fees, dtype=FEE_DTYPE))
+	return cached
+
+
+def cache_fees(conn, w3, block, base_fee, fees):
+	"""
+	Stores the fee columns of block if it is finalized (the caller commits)
+	Returns whether the block was stored
+	"""
+	if not is_finalized(w3, block.number):
+		return False
+	conn.execute("INSERT OR IGNORE INTO block_fees (chain_id, number, hash, base_fee, fees) VALUES (?, ?, ?, ?, ?)",
+				 (get_chain_id(w3), block.number, bytes(block.hash), base_fee, fees.tobytes()))
+	return True
+
+
+def get_chain_id(w3):
+	"""
+	Returns the chain id of the chain w3 is connected to, asking the node only once per connection
+	"""
+	if id(w3) not in _chain_ids:
+		_chain_ids[id(w3)] = w3.eth.chain_id
+	return _chain_ids[id(w3)]
+
+
+def is_finalized(w3, block_num):
+	"""
+	Returns whether block_num is at or below the chain's finalized block
+	The finalized block number only ever grows, so it is only fetched again for blocks above the last one seen
+	Chains without the 'finalized' tag count blocks FINALITY_DEPTH below the tip as final
+	"""
+	if _finalized.get(id(w3), -1) < block_num:
+		try:
+			_finalized[id(w3)] = w3.eth.get_block('finalized').number
+		except Exception:
+			_finalized[id(w3)] = w3.eth.get_block_number() - FINALITY_DEPTH
+	return block_num <= _finalized[id(w3)]
+
+
+def get_blocks(w3, block_nums, batch_size=RPC_BATCH_SIZE, workers=RPC_WORKERS):
+	"""
+	Fetches the blocks in block_nums with full transactions
+	Each group of batch_size blocks is one JSON-RPC batch request, and up to workers batches are in flight at once
+	Yields the blocks in the same order as block_nums. A new batch is only requested once the oldest one is being
+	handed to the caller, so memory holds at most that batch plus workers in flight, however slowly the caller
+	consumes them
+	"""
+	block_nums = list(block_nums)
+	batches = iter([block_nums[i:i + batch_size] for i in range(0, len(block_nums), batch_size)])
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		in_flight = deque()
+		for batch_nums in batches:
+			in_flight.append(executor.submit(get_block_batch, w3, batch_nums))
+			if len(in_flight) == workers:
+				break
+		while in_flight:
+			blocks = in_flight.popleft().result()
+			batch_nums = next(batches, None)
+			if batch_nums is not None:
+				in_flight.append(executor.submit(get_block_batch, w3, batch_nums))
+			yield from blocks
+
 
-	return ordered
+def get_block_batch(w3, block_nums):
+	"""
+	Fetches block_nums (full transactions) in a single JSON-RPC batch request
+	Falls back to one request per block if the provider rejects the batch
+	"""
+	try:
+		with w3.batch_requests() as batch:
+			for block_num in block_nums:
+				batch.add(w3.eth.get_block(block_num, full_transactions=True))
+			return batch.execute()
+	except Exception as e:
+		print(f"Batch request for blocks {block_nums[0]} - {block_nums[-1]} failed ({e}), fetching them one at a time")
+		return [w3.eth.get_block(block_num, full_transactions=True) for block_num in block_nums]
+
+
+def analyze_blocks(w3, block_nums, batch_size=RPC_BATCH_SIZE, workers=RPC_WORKERS, cache_db=None):
+	"""
+	Takes a list of block numbers (or a range)
+	Returns (results, stats)
+		results - a list with one dictionary per block: number, transactions (count) and ordered (see is_ordered_block)
+		stats - totals over all the blocks: blocks, empty, ordered, unordered, ordered_fraction (of the non-empty blocks)
+		        and transactions
+	If cache_db is given, blocks found in it are not fetched again, and finalized blocks that had to be fetched are added to it
+	"""
+	block_nums = list(block_nums)
+	conn = open_block_cache(cache_db) if cache_db is not None else None
+	try:
+		cached = get_cached_fees(conn, get_chain_id(w3), block_nums) if conn is not None else {}
+		missing = [block_num for block_num in block_nums if block_num not in cached]
+		fetched = get_blocks(w3, missing, batch_size, workers)
+		results = []
+		for block_num in block_nums:
+			if block_num in cached:
+				base_fee, fees = cached[block_num]
+			else:
+				block = next(fetched)
+				base_fee, fees = fee_columns(block)
+				if conn is not None:
+					cache_fees(conn, w3, block, base_fee, fees)
+			results.append({
+				'number': block_num,
+				'transactions': len(fees),
+				'ordered': is_ordered_fees(base_fee, fees),
+			})
+		if conn is not None:
+			conn.commit()
+	finally:
+		if conn is not None:
+			conn.close()
+
+	non_empty = [r for r in results if r['transactions'] > 0]
+	ordered = sum(1 for r in non_empty if r['ordered'])
+	stats = {
+		'blocks': len(results),
+		'empty': len(results) - len(non_empty),
+		'ordered': ordered,
+		'unordered': len(non_empty) - ordered,
+		'ordered_fraction': ordered / len(non_empty) if non_empty else 0,
+		'transactions': sum(r['transactions'] for r in results),
+	}
+	return results, stats
+
+
+def analyze_block_range(w3, start_block, end_block, batch_size=RPC_BATCH_SIZE, workers=RPC_WORKERS, cache_db=None):
+	"""
+	Same as analyze_blocks for every block from start_block to end_block (inclusive)
+	"""
+	return analyze_blocks(w3, range(start_block, end_block + 1), batch_size, workers, cache_db)
 
 
 def get_contract_values(contract, admin_address, owner_address):
@@ -116,10 +320,11 @@ if __name__ == "__main__":
 	assert latest_block > london_hard_fork_block_num, f"Error: the chain never got past the London Hard Fork"
 
 	n = 5
-	for _ in range(n):
-		block_num = random.randint(1, latest_block)
-		ordered = is_ordered_block(eth_w3, block_num)
-		if ordered:
-			print(f"Block {block_num} is ordered")
+	block_nums = [random.randint(1, latest_block) for _ in range(n)]
+	results, stats = analyze_blocks(eth_w3, block_nums, cache_db=BLOCK_CACHE_DB)
+	for result in results:
+		if result['ordered']:
+			print(f"Block {result['number']} is ordered")
 		else:
-			print(f"Block {block_num} is not ordered")
+			print(f"Block {result['number']} is not ordered")
+	print(f"{stats['ordered']} of {stats['blocks'] - stats['empty']} non-empty blocks are ordered ({stats['ordered_fraction']:.1%})")
@@ -0,0 +1,339 @@
+from web3 import Web3
+from web3.datastructures import AttributeDict
+from web3.exceptions import TransactionNotFound
+from web3._utils.method_formatters import receipt_formatter
+import time
+import threading
+import fees
+
+
+# Next nonce to use for each (chain, address), so we only ask the node on startup or after an error
+_nonces = {}
+_nonce_lock = threading.Lock()  # send_batch is also called from tracker threads (see get_tracker)
+# Process-wide ReceiptTracker for each (chain, address), polling in the background
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def sync_nonce(w3, chain, address):
+    """
+        Reloads the next nonce for address on chain from the node (including pending transactions)
+    """
+    nonce = w3.eth.get_transaction_count(address, 'pending')
+    with _nonce_lock:
+        _nonces[(chain, address)] = nonce
+    return nonce
+
+
+def next_nonce(w3, chain, address):
+    """
+        Returns the next nonce to use for address on chain and reserves it
+        The node is only queried the first time we see (chain, address)
+    """
+    key = (chain, address)
+    # The check, the reload and the reservation happen under one lock, otherwise two threads sending from the
+    # same address could both reload after reset_nonce and hand out the same nonce twice
+    with _nonce_lock:
+        if key not in _nonces:
+            _nonces[key] = w3.eth.get_transaction_count(address, 'pending')
+        nonce = _nonces[key]
+        _nonces[key] = nonce + 1
+    return nonce
+
+
+def reset_nonce(chain, address):
+    """
+        Forgets the local nonce for address on chain, so the next call to next_nonce reloads it from the node
+    """
+    with _nonce_lock:
+        _nonces.pop((chain, address), None)
+
+
+def get_tracker(w3, chain, account):
+    """
+        Returns the process-wide ReceiptTracker for transactions sent by account on chain,
+        creating it (and starting its background thread) on first use
+        Receipts are then checked without blocking the caller, and stuck transactions keep being replaced
+        for as long as the process runs
+    """
+    key = (chain, account.address)
+    with _trackers_lock:
+        if key not in _trackers:
+            tracker = ReceiptTracker(w3, account)
+            tracker.start()
+            _trackers[key] = tracker
+        return _trackers[key]
+
+
+def wait_for_trackers(timeout=120):
+    """
+        Waits up to timeout seconds (in total) for every transaction the process-wide trackers are watching
+        Returns True if nothing is outstanding any more
+    """
+    deadline = time.time() + timeout
+    with _trackers_lock:
+        trackers = list(_trackers.values())
+    return all([tracker.wait(timeout=max(0, deadline - time.time())) for tracker in trackers])
+
+
+def transaction_state(w3, address, nonce, tx_hash):
+    """
+        Returns what became of the transaction tx_hash sent by address with nonce, when no tracker is watching it
+        (e.g. it was sent by an earlier process):
+        'confirmed' or 'failed' once the nonce is used, 'pending' while the node still holds a transaction with
+        that nonce, and 'dropped' if there is none, so the call has to be sent again
+        If the nonce was used by a replacement of tx_hash (same call, higher fees), it counts as 'confirmed'
+    """
+    if nonce < w3.eth.get_transaction_count(address, 'latest'):
+        try:
+            receipt = w3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return 'confirmed'
+        return 'confirmed' if receipt['status'] == 1 else 'failed'
+    if nonce < w3.eth.get_transaction_count(address, 'pending'):
+        return 'pending'
+    # Not every node counts its own pending transactions in the 'pending' nonce (eth-tester doesn't)
+    try:
+        w3.eth.get_transaction(tx_hash)
+        return 'pending'
+    except TransactionNotFound:
+        return 'dropped'
+
+
+def send_batch(w3, chain, account, calls, gas=None, tracker=None, on_confirmed=None, on_failed=None, on_sent=None,
+               default_gas=fees.DEFAULT_GAS):
+    """
+        w3 - web3 instance connected to chain
+        chain - (string) name of the chain, used to key the local nonce counter
+        account - the account that signs the transactions
+        calls - list of contract function calls, e.g. contract.functions.wrap(token, recipient, amount)
+        gas - gas limit for every call, or a list with one gas limit per call
+              If None, each call uses a cached gas estimate for its function and token, or default_gas if it
+              cannot be estimated
+        tracker - (optional) ReceiptTracker to hand every sent transaction to
+        on_confirmed, on_failed - (optional) tracker callbacks, called as callback(index, tx_hash, receipt)
+                                  where index is the position of the call in calls
+        on_sent - (optional) called as on_sent(index, tx_hash, nonce) as soon as each transaction is accepted by the
+                  node, so callers can record progress even if a later call in the batch fails to send
+
+        Signs and sends every call back-to-back with locally assigned nonces, without waiting for receipts
+        Returns the list of transaction hashes in the same order as calls
+        If sending fails, the local nonce is dropped (so it is reloaded from the node) and the error is raised
+    """
+    # One fee lookup per block window, shared by every transaction in the batch
+    fee_params = fees.get_fee_params(w3)
+    if gas is None:
+        gas = [fees.estimate_gas(w3, call, account.address, default_gas) for call in calls]
+    elif isinstance(gas, int):
+        gas = [gas] * len(calls)
+    tx_hashes = []
+    for call, call_gas in zip(calls, gas):
+        nonce = next_nonce(w3, chain, account.address)
+        try:
+            transaction = call.build_transaction({
+                'from': account.address,
+                'nonce': nonce,
+                'gas': call_gas,
+                **fee_params,
+            })
+            signed_txn = w3.eth.account.sign_transaction(transaction, account.key)
+            tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        except Exception as e:
+            print(f"Error sending transaction with nonce {nonce} on {chain}: {e}")
+            reset_nonce(chain, account.address)
+            raise
+        tx_hashes.append(tx_hash)
+        index = len(tx_hashes) - 1
+        if on_sent is not None:
+            on_sent(index, tx_hash, nonce)
+        if tracker is not None:
+            tracker.track(
+                tx_hash, transaction,
+                on_confirmed=None if on_confirmed is None else lambda h, r, i=index: on_confirmed(i, h, r),
+                on_failed=None if on_failed is None else lambda h, r, i=index: on_failed(i, h, r),
+            )
+    return tx_hashes
+
+
+class ReceiptTracker:
+    """
+        Watches the receipts of transactions sent by account on one chain
+        Outstanding transactions are polled together, in one batch request, every poll_interval seconds
+        (in a background thread after start(), or by calling poll() directly). Confirmations and failures are reported through the
+        callbacks given to track(). A transaction that stays pending for stuck_after seconds is replaced by
+        the same transaction with fees bumped by fee_bump, at the same nonce
+    """
+    def __init__(self, w3, account, poll_interval=2, stuck_after=60, fee_bump=1.2, max_replacements=3):
+        self.w3 = w3
+        self.account = account
+        self.poll_interval = poll_interval
+        self.stuck_after = stuck_after
+        self.fee_bump = fee_bump
+        self.max_replacements = max_replacements
+        self.pending = {}  # nonce -> dict with the transaction, every hash sent for it and the callbacks
+        self.batching = True  # Cleared if the provider rejects batch requests
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def track(self, tx_hash, transaction, on_confirmed=None, on_failed=None):
+        """
+            Starts tracking tx_hash, which was sent as transaction (the unsigned dict)
+            on_confirmed(tx_hash, receipt) is called once it is mined with status 1
+            on_failed(tx_hash, receipt) is called if it reverts, or with receipt None if it can no longer be replaced
+        """
+        with self.lock:
+            self.pending[transaction['nonce']] = {
+                'transaction': transaction,
+                'hashes': [tx_hash],
+                'sent_at': time.time(),
+                'replacements': 0,
+                'on_confirmed': on_confirmed,
+                'on_failed': on_failed,
+            }
+
+    def outstanding(self):
+        with self.lock:
+            return len(self.pending)
+
+    def tracking(self, nonce):
+        with self.lock:
+            return nonce in self.pending
+
+    def get_receipts(self, tx_hashes):
+        """
+            Returns a dictionary mapping each mined hash in tx_hashes to its receipt
+            The receipts are requested in one JSON-RPC batch, or one request per hash if the provider can't batch
+        """
+        if len(tx_hashes) == 0:
+            return {}
+        if self.batching:
+            try:
+                responses = self.w3.provider.make_batch_request(
+                    [('eth_getTransactionReceipt', [Web3.to_hex(tx_hash)]) for tx_hash in tx_hashes]
+                )
+            except Exception as e:
+                responses = e
+            if isinstance(responses, list) and len(responses) == len(tx_hashes):
+                # A pending transaction has a null result, and is left out
+                return {
+                    tx_hash: AttributeDict.recursive(receipt_formatter(response['result']))
+                    for tx_hash, response in zip(tx_hashes, responses) if response.get('result')
+                }
+            print(f"Batched receipt polling unavailable, polling one receipt at a time: {responses}")
+            self.batching = False
+
+        receipts = {}
+        for tx_hash in tx_hashes:
+            try:
+                receipts[tx_hash] = self.w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                continue
+            except Exception as e:
+                print(f"Error getting receipt for {tx_hash.hex()}: {e}")
+        return receipts
+
+    def poll(self):
+        """
+            Checks every outstanding transaction once (in one batch request), reporting mined ones and
+            replacing stuck ones
+        """
+        with self.lock:
+            entries = list(self.pending.items())
+        # Any of the hashes sent for a nonce may be the one that gets mined
+        receipts = self.get_receipts([sent_hash for _, entry in entries for sent_hash in entry['hashes']])
+        for nonce, entry in entries:
+            receipt = None
+            tx_hash = None
+            for sent_hash in entry['hashes']:
+                if sent_hash in receipts:
+                    receipt = receipts[sent_hash]
+                    tx_hash = sent_hash
+                    break
+
+            if receipt is not None:
+                # The entry stays outstanding until its callback returns, since a callback may send (and track) more
+                try:
+                    if receipt['status'] == 1:
+                        if entry['on_confirmed'] is not None:
+                            entry['on_confirmed'](tx_hash, receipt)
+                    elif entry['on_failed'] is not None:
+                        entry['on_failed'](tx_hash, receipt)
+                finally:
+                    with self.lock:
+                        self.pending.pop(nonce, None)
+            elif time.time() - entry['sent_at'] >= self.stuck_after:
+                self.replace(nonce, entry)
+
+    def replace(self, nonce, entry):
+        """
+            Re-sends the transaction for nonce with higher fees
+        """
+        if entry['replacements'] >= self.max_replacements:
+            print(f"Giving up on transaction with nonce {nonce}: {entry['hashes'][-1].hex()}")
+            try:
+                if entry['on_failed'] is not None:
+                    entry['on_failed'](entry['hashes'][-1], None)
+            finally:
+                with self.lock:
+                    self.pending.pop(nonce, None)
+            return
+
+        transaction = dict(entry['transaction'])
+        current = fees.get_fee_params(self.w3)
+        for field in ['gasPrice', 'maxFeePerGas', 'maxPriorityFeePerGas']:
+            if field in transaction:
+                # Nodes only accept a replacement that pays noticeably more than the original
+                transaction[field] = max(int(transaction[field] * self.fee_bump), current.get(field, 0))
+        if 'maxFeePerGas' in transaction:
+            transaction['maxFeePerGas'] = max(transaction['maxFeePerGas'], transaction['maxPriorityFeePerGas'])
+
+        entry['replacements'] += 1
+        entry['sent_at'] = time.time()
+        try:
+            signed_txn = self.w3.eth.account.sign_transaction(transaction, self.account.key)
+            tx_hash = self.w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        except Exception as e:
+            # Most likely the original was mined in the meantime, the next poll will find its receipt
+            print(f"Error replacing transaction with nonce {nonce}: {e}")
+            return
+        print(f"Replaced stuck transaction with nonce {nonce}: {entry['hashes'][-1].hex()} -> {tx_hash.hex()}")
+        entry['transaction'] = transaction
+        entry['hashes'].append(tx_hash)
+
+    def wait(self, timeout=120):
+        """
+            Polls until nothing is outstanding or timeout seconds pass
+            Returns True if every tracked transaction was resolved
+        """
+        deadline = time.time() + timeout
+        while self.outstanding() > 0 and time.time() < deadline:
+            if self.thread is None:
+                self.poll()
+            if self.outstanding() > 0:
+                time.sleep(self.poll_interval)
+        return self.outstanding() == 0
+
+    def start(self):
+        """
+            Polls in a background thread until stop() is called
+        """
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling receipts: {e}")
+            self.stop_event.wait(self.poll_interval)
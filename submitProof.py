@@ -1,10 +1,27 @@
 import eth_account
 import random
 import string
-import json
+import os
 from pathlib import Path
 from web3 import Web3
-from web3.middleware import ExtraDataToPOAMiddleware  # Necessary for POA chains
+import math
+from collections import deque
+import struct
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from eth_hash.auto import keccak
+import clients
+import fees
+import relayer
+
+
+PRIME_CACHE_FILE = "primes_cache.npy"  # Primes from earlier runs, next to this file
+SIEVE_SEGMENT_SIZE = 1 << 20  # Numbers sieved at a time by sieve_primes
+PARALLEL_HASH_THRESHOLD = 1 << 16  # Smallest tree level worth splitting between processes
+PARALLEL_VERIFY_THRESHOLD = 1 << 12  # Smallest batch of proofs worth splitting between processes
+MERKLE_MAGIC = b"MERKLE01"  # First bytes of a file written by save_merkle
+
+_prime_cache = None  # numpy array of the primes generated so far in this process
 
 
 def merkle_assignment():
@@ -33,6 +50,11 @@ def merkle_assignment():
     # Sign the challenge to prove to the grader you hold the account
     addr, sig = sign_challenge(challenge)
 
+    # Check the proof locally first, an invalid claim would only revert on-chain and waste gas
+    if not verify_merkle_batch([leaves[random_leaf_index]], [proof], tree[-1][0])[0]:
+        print(f"Proof for leaf {random_leaf_index} does not verify, not sending the claim")
+        return
+
     if sign_challenge_verify(challenge, addr, sig):
         tx_hash = send_signed_msg(proof, leaves[random_leaf_index])
         print(f"Transaction hash: {tx_hash}")
@@ -43,23 +65,98 @@ def generate_primes(num_primes):
         Function to generate the first 'num_primes' prime numbers
         returns list (with length n) of primes (as ints) in ascending order
     """
-    primes_list = []
-    
+    global _prime_cache
+
     if num_primes <= 0:
-        return primes_list
-    
-    num = 2
-    while len(primes_list) < num_primes:
-        is_prime = True
-        for i in range(2, int(num ** 0.5) + 1):
-            if num % i == 0:
-                is_prime = False
+        return []
+
+    if _prime_cache is None or len(_prime_cache) < num_primes:
+        cache_file = Path(__file__).parent.absolute() / PRIME_CACHE_FILE
+        cached = load_prime_cache(cache_file)
+        if cached is not None and len(cached) >= num_primes:
+            _prime_cache = cached
+        else:
+            _prime_cache = sieve_primes(nth_prime_upper_bound(num_primes))
+            save_prime_cache(cache_file, _prime_cache)
+
+    return _prime_cache[:num_primes].tolist()
+
+
+def load_prime_cache(cache_file):
+    """
+        Returns the primes saved in cache_file, or None if it is missing or unreadable (a cache miss)
+    """
+    try:
+        if not cache_file.is_file():
+            return None
+        primes = np.load(cache_file)
+    except Exception as e:
+        print(f"Ignoring unreadable prime cache {cache_file}: {e}")
+        return None
+    if primes.ndim != 1 or primes.dtype.kind not in 'iu':
+        print(f"Ignoring prime cache {cache_file} with unexpected contents")
+        return None
+    return primes
+
+
+def save_prime_cache(cache_file, primes):
+    """
+        Saves primes to cache_file for later runs
+        The file is replaced atomically, so an interrupted write never leaves a truncated cache behind
+        Failing to save (e.g. a read-only install) is not an error, the primes are just not cached on disk
+    """
+    tmp_file = f"{cache_file}.tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.save(f, primes)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        print(f"Could not save prime cache {cache_file}: {e}")
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def nth_prime_upper_bound(n):
+    """
+        Returns a number that is at least as large as the nth prime
+        (Rosser's bound n * (ln n + ln ln n), which holds for n >= 6)
+    """
+    if n < 6:
+        return 13
+    return int(n * (math.log(n) + math.log(math.log(n)))) + 1
+
+
+def sieve_primes(limit, segment_size=SIEVE_SEGMENT_SIZE):
+    """
+        Segmented Sieve of Eratosthenes
+        Returns a numpy array of all the primes <= limit in ascending order
+        Memory use is one segment of segment_size flags plus the primes found
+    """
+    # Plain sieve for the base primes up to sqrt(limit)
+    root = math.isqrt(limit)
+    is_prime = np.ones(root + 1, dtype=bool)
+    is_prime[:2] = False
+    for i in range(2, math.isqrt(root) + 1):
+        if is_prime[i]:
+            is_prime[i * i::i] = False
+    base_primes = np.nonzero(is_prime)[0]
+
+    segments = []
+    for low in range(0, limit + 1, segment_size):
+        high = min(low + segment_size, limit + 1)
+        segment = np.ones(high - low, dtype=bool)
+        if low < 2:
+            segment[:2 - low] = False
+        for p in base_primes.tolist():
+            if p * p >= high:
                 break
-        if is_prime:
-            primes_list.append(num)
-        num += 1
-    
-    return primes_list
+            # First multiple of p in the segment, never below p*p (smaller multiples have a smaller factor)
+            start = max(p * p, (low + p - 1) // p * p)
+            segment[start - low::p] = False
+        segments.append(np.nonzero(segment)[0] + low)
+    return np.concatenate(segments).astype(np.int64)
 
 
 def convert_leaves(primes_list):
@@ -75,28 +172,115 @@ def convert_leaves(primes_list):
     return leaves
 
 
-def build_merkle(leaves):
+def build_merkle(leaves, processes=None):
     """
         Function to build a Merkle Tree from the list of prime numbers in bytes32 format
         Returns the Merkle tree (tree) as a list where tree[0] is the list of leaves,
         tree[1] is the parent hashes, and so on until tree[n] which is the root hash
         the root hash produced by the "hash_pair" helper function
+        processes - (optional) number of worker processes used to hash large levels
     """
-    tree = [leaves]
-    
-    current_level = leaves
-    while len(current_level) > 1:
-        next_level = []
-        for i in range(0, len(current_level), 2):
-            if i + 1 < len(current_level):
-                pair_hash = hash_pair(current_level[i], current_level[i + 1])
-                next_level.append(pair_hash)
+    levels = build_merkle_levels(leaves, processes)
+    return [[bytes(node) for node in level] for level in levels]
+
+
+def build_merkle_levels(leaves, processes=None):
+    """
+        Same tree as build_merkle, but each level is a numpy array of shape (nodes, 32) of uint8
+        Each level is hashed in one batch: the sorted pairs are laid out in one contiguous buffer
+        and hashed with raw keccak-256, which gives the same hashes as hash_pair
+        An odd node at the end of a level is carried up unchanged
+    """
+    level = np.frombuffer(b''.join(leaves), dtype=np.uint8).reshape(-1, 32)
+    levels = [level]
+    while len(level) > 1:
+        num_pairs = len(level) // 2
+        buffer = sorted_pairs(level[0:2 * num_pairs:2], level[1:2 * num_pairs:2])
+        if processes and num_pairs >= PARALLEL_HASH_THRESHOLD:
+            hashes = hash_pairs_parallel(buffer, processes)
+        else:
+            hashes = hash_pairs(buffer)
+        next_level = np.frombuffer(hashes, dtype=np.uint8).reshape(-1, 32)
+        if len(level) % 2 == 1:
+            next_level = np.concatenate([next_level, level[-1:]])
+        levels.append(next_level)
+        level = next_level
+    return levels
+
+
+def sorted_pairs(left, right):
+    """
+        left, right - numpy arrays of shape (pairs, 32)
+        Returns one contiguous buffer where pair i is the smaller of left[i], right[i] followed by the larger
+        (the order OpenZeppelin's MerkleProof uses)
+    """
+    # Compare as bytes: the first differing byte decides the order
+    differs = left != right
+    first = np.argmax(differs, axis=1)
+    rows = np.arange(len(left))
+    swap = left[rows, first] > right[rows, first]
+    pairs = np.empty((len(left), 64), dtype=np.uint8)
+    pairs[:, :32] = np.where(swap[:, None], right, left)
+    pairs[:, 32:] = np.where(swap[:, None], left, right)
+    return pairs.tobytes()
+
+
+def hash_pairs(buffer):
+    """
+        Returns the keccak-256 hashes of each 64 byte pair in buffer, concatenated
+    """
+    return b''.join([keccak(buffer[i:i + 64]) for i in range(0, len(buffer), 64)])
+
+
+def hash_pairs_parallel(buffer, processes):
+    """
+        Same as hash_pairs, with the buffer split between a pool of worker processes
+    """
+    num_pairs = len(buffer) // 64
+    chunk = -(-num_pairs // processes) * 64
+    chunks = [buffer[i:i + chunk] for i in range(0, len(buffer), chunk)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return b''.join(executor.map(hash_pairs, chunks))
+
+
+def save_merkle(tree, filename):
+    """
+        Writes a Merkle tree (from build_merkle or build_merkle_levels) to filename in a flat binary format:
+          8 bytes   magic "MERKLE01"
+          8 bytes   number of levels (little endian)
+          8 bytes   number of nodes in each level, one entry per level
+          32 bytes  for every node, level 0 (the leaves) first and the root last
+    """
+    counts = [len(level) for level in tree]
+    with open(filename, 'wb') as f:
+        f.write(MERKLE_MAGIC)
+        f.write(struct.pack(f'<{len(counts) + 1}Q', len(counts), *counts))
+        for level in tree:
+            if isinstance(level, np.ndarray):
+                f.write(level.tobytes())
             else:
-                next_level.append(current_level[i])
-        tree.append(next_level)
-        current_level = next_level
-    
-    return tree
+                f.write(b''.join(level))
+
+
+def open_merkle(filename):
+    """
+        Opens a tree written by save_merkle without reading it into memory
+        Returns a list of levels where each level is a read-only numpy array of shape (nodes, 32)
+        backed by a memory map, so prove_merkle only touches the O(log n) pages it needs
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MERKLE_MAGIC)) != MERKLE_MAGIC:
+            raise ValueError(f"{filename} is not a Merkle tree file")
+        num_levels, = struct.unpack('<Q', f.read(8))
+        counts = struct.unpack(f'<{num_levels}Q', f.read(8 * num_levels))
+
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    offset = len(MERKLE_MAGIC) + 8 * (num_levels + 1)
+    levels = []
+    for count in counts:
+        levels.append(data[offset:offset + 32 * count].reshape(-1, 32))
+        offset += 32 * count
+    return levels
 
 
 def prove_merkle(merkle_tree, random_indx):
@@ -105,6 +289,7 @@ def prove_merkle(merkle_tree, random_indx):
         as a list of lists where index 0 is the list of leaves, index 1 is the list of
         parent hash values, up to index -1 which is the list of the root hash.
         returns a proof of inclusion as list of values
+        The tree can also be the levels from build_merkle_levels or open_merkle
     """
     merkle_proof = []
     
@@ -115,16 +300,154 @@ def prove_merkle(merkle_tree, random_indx):
         else:
             sibling_index = current_index - 1
         
+        # A node without a sibling is carried up unchanged, so there is nothing to add to the proof
+        # bytes() so rows of a tree opened with open_merkle come back as plain bytes32 values
         if sibling_index < len(merkle_tree[level]):
-            merkle_proof.append(merkle_tree[level][sibling_index])
-        else:
-            merkle_proof.append(merkle_tree[level][current_index])
+            merkle_proof.append(bytes(merkle_tree[level][sibling_index]))
         
         current_index = current_index // 2
     
     return merkle_proof
 
 
+def prove_merkle_batch(merkle_tree, indices):
+    """
+        Returns the proofs (same as prove_merkle) for every leaf index in indices, in one pass over the tree
+        Sibling hashes shared between proofs are read once and the same bytes object is reused
+    """
+    proofs = [[] for _ in indices]
+    current = np.asarray(indices, dtype=np.int64)
+    for level in range(len(merkle_tree) - 1):
+        siblings = current ^ 1
+        has_sibling = np.nonzero(siblings < len(merkle_tree[level]))[0]
+        unique_siblings, positions = np.unique(siblings[has_sibling], return_inverse=True)
+        nodes = [bytes(merkle_tree[level][j]) for j in unique_siblings.tolist()]
+        for k, pos in zip(has_sibling.tolist(), positions.tolist()):
+            proofs[k].append(nodes[pos])
+        current = current // 2
+    return proofs
+
+
+def prove_merkle_multi(merkle_tree, indices):
+    """
+        Builds a multiproof for the leaves at indices, in the format of OpenZeppelin's
+        MerkleProof.multiProofVerify(proof, proofFlags, root, leaves)
+        https://github.com/OpenZeppelin/openzeppelin-contracts/blob/master/contracts/utils/cryptography/MerkleProof.sol
+        Sibling hashes that can be computed from other proven leaves are not included
+        Returns (proof, proof_flags, leaves), where leaves are in the order the verifier expects (ascending index)
+        Raises ValueError if a leaf's path goes through a node that is carried up a level without a sibling,
+        since the OpenZeppelin verifier has no way to express that
+    """
+    top = len(merkle_tree) - 1
+    queue = deque((0, i) for i in sorted(set(indices)))
+    leaves = [bytes(merkle_tree[0][i]) for _, i in queue]
+    proof = []
+    proof_flags = []
+    while len(queue) > 0 and queue[0][0] < top:
+        level, index = queue.popleft()
+        sibling = index ^ 1
+        if sibling >= len(merkle_tree[level]):
+            raise ValueError(f"Node {index} of level {level} has no sibling, it cannot be part of a multiproof")
+        if len(queue) > 0 and queue[0] == (level, sibling):
+            # Both children are already known to the verifier
+            queue.popleft()
+            proof_flags.append(True)
+        else:
+            proof.append(bytes(merkle_tree[level][sibling]))
+            proof_flags.append(False)
+        queue.append((level + 1, index // 2))
+    return proof, proof_flags, leaves
+
+
+def verify_merkle_batch(leaves, proofs, root, processes=None):
+    """
+        Checks many (leaf, proof) pairs against root with the same sorted-pair keccak rules as hash_pair
+        (OpenZeppelin's MerkleProof.verify)
+        leaves - list of bytes32 leaves, proofs - list of proofs (lists of bytes32), one per leaf
+        processes - (optional) number of worker processes to split large batches between
+        Returns a list of booleans, one per leaf
+    """
+    if processes and len(leaves) >= PARALLEL_VERIFY_THRESHOLD:
+        chunk = -(-len(leaves) // processes)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [
+                executor.submit(verify_merkle_batch, leaves[i:i + chunk], proofs[i:i + chunk], root)
+                for i in range(0, len(leaves), chunk)
+            ]
+            return [ok for future in futures for ok in future.result()]
+
+    root = bytes(root)
+    results = [False] * len(leaves)
+    # Proofs of the same length are hashed together, one level at a time
+    by_length = {}
+    for i, proof in enumerate(proofs):
+        by_length.setdefault(len(proof), []).append(i)
+    for length, positions in by_length.items():
+        current = np.frombuffer(b''.join(bytes(leaves[i]) for i in positions), dtype=np.uint8).reshape(-1, 32)
+        for step in range(length):
+            siblings = np.frombuffer(b''.join(bytes(proofs[i][step]) for i in positions), dtype=np.uint8).reshape(-1, 32)
+            current = np.frombuffer(hash_pairs(sorted_pairs(current, siblings)), dtype=np.uint8).reshape(-1, 32)
+        matches = (current == np.frombuffer(root, dtype=np.uint8)).all(axis=1)
+        for i, ok in zip(positions, matches.tolist()):
+            results[i] = ok
+    return results
+
+
+def merkle_append(merkle_tree, leaf):
+    """
+        Adds leaf (bytes32) to the end of a tree from build_merkle, updating the tree in place
+        Only the O(log n) nodes on the new leaf's path are hashed
+        Returns the new root
+    """
+    merkle_tree[0].append(bytes(leaf))
+    return _update_path(merkle_tree, len(merkle_tree[0]) - 1)
+
+
+def merkle_update(merkle_tree, index, leaf):
+    """
+        Replaces the leaf at index in a tree from build_merkle, updating the tree in place
+        Only the O(log n) nodes on the leaf's path are hashed
+        Returns the new root
+    """
+    merkle_tree[0][index] = bytes(leaf)
+    return _update_path(merkle_tree, index)
+
+
+def _update_path(merkle_tree, index):
+    """
+        Recomputes the parents of node index of level 0 up to the root, adding nodes and levels as needed
+    """
+    level = 0
+    while len(merkle_tree[level]) > 1:
+        nodes = merkle_tree[level]
+        left = index - index % 2
+        if left + 1 < len(nodes):
+            value = keccak_pair(nodes[left], nodes[left + 1])
+        else:
+            # No sibling, the node is carried up unchanged (as in build_merkle)
+            value = nodes[left]
+        if level + 1 == len(merkle_tree):
+            merkle_tree.append([])
+        parents = merkle_tree[level + 1]
+        index = index // 2
+        if index == len(parents):
+            parents.append(value)
+        else:
+            parents[index] = value
+        level += 1
+    return merkle_tree[level][0]
+
+
+def keccak_pair(a, b):
+    """
+        Same hash as hash_pair, computed with raw keccak-256 and returned as bytes
+    """
+    if a < b:
+        return keccak(a + b)
+    else:
+        return keccak(b + a)
+
+
 def sign_challenge(challenge):
     """
         Takes a challenge (string)
@@ -156,7 +479,7 @@ def send_signed_msg(proof, random_leaf):
     contract_address, abi = get_contract_info(chain)
     w3 = connect_to(chain)
     
-    contract = w3.eth.contract(address=contract_address, abi=abi)
+    contract = clients.get_contract(w3, contract_address, abi)
     
     nonce = w3.eth.get_transaction_count(acct.address)
     
@@ -164,13 +487,20 @@ def send_signed_msg(proof, random_leaf):
         'from': acct.address,
         'nonce': nonce,
         'gas': 200000,
-        'gasPrice': w3.eth.gas_price,
+        **fees.get_fee_params(w3),
     })
     
     signed_txn = w3.eth.account.sign_transaction(transaction, acct.key)
     tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
     
-    receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
+    # Wait (with a timeout) for the receipt, re-sending with higher fees if the claim gets stuck
+    mined = {}
+    tracker = relayer.ReceiptTracker(w3, acct)
+    tracker.track(tx_hash, transaction,
+                  on_confirmed=lambda h, r: mined.update(tx_hash=h),
+                  on_failed=lambda h, r: mined.update(tx_hash=h))
+    tracker.wait(timeout=300)
+    tx_hash = mined.get('tx_hash', tx_hash)
     
     return tx_hash.hex()
 
@@ -188,9 +518,8 @@ def connect_to(chain):
         api_url = f"https://api.avax-test.network/ext/bc/C/rpc"  # AVAX C-chain testnet
     else:
         api_url = f"https://data-seed-prebsc-1-s1.binance.org:8545/"  # BSC testnet
-    w3 = Web3(Web3.HTTPProvider(api_url))
-    # inject the poa compatibility middleware to the innermost layer
-    w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+    # Shared instance with a pooled HTTP session and the poa middleware already injected
+    w3 = clients.get_web3(api_url)
 
     return w3
 
@@ -216,9 +545,7 @@ def get_contract_info(chain):
     contract_file = Path(__file__).parent.absolute() / "contract_info.json"
     if not contract_file.is_file():
         contract_file = Path(__file__).parent.parent.parent / "tests" / "contract_info.json"
-    with open(contract_file, "r") as f:
-        d = json.load(f)
-        d = d[chain]
+    d = clients.load_contract_info(contract_file)[chain]
     return d['address'], d['abi']
 
 